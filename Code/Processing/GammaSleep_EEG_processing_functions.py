@@ -17,7 +17,13 @@ import matplotlib.pyplot as plt
 import yasa
 import pandas as pd 
 import scipy
-import random
+import re
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+# Channel names in the EDF files, renamed to match Neurofax headbox
+channel_renames = {'Cz':'Oz', 'P3':'PO3', 'P4':'PO4', 'Pz':'POz', 'PG1':'LEOG', 'PG2':'REOG', 'T1':'LEMG', 'T2':'REMG'}
 
 
 
@@ -34,60 +40,100 @@ import random
     Names of bad channels identified visually.
     Examples: [] (no bad channels); ['LEMG'] (1 bad channel); ['C3','LEMG'] (more than 1 bad channel)
     
+    stream_PSG : bool
+    If True, PSG channels are streamed from the file by load_PSG_stream(), without loading them at full rate (default: False)
+    
+    dtype : numpy dtype
+    Optional data type of the EEG data, e.g. np.float32 to halve memory; kept by all later processing steps (default: None, float64 as loaded by MNE)
+    
+    psg : bool
+    If False, PSG channels are neither loaded nor processed, and raw_PSG is None (default: True)
+    
     Output
     -------
     raw_PSG : MNE raw object
-    Processed data in MNE format - PSG channels
+    Processed data in MNE format - PSG channels; None if psg is False
     
     raw_EEG : MNE raw object
     Processed data in MNE format - EEG channels
 
 """
 
-def load_raw(filename,bad_ch):
+def load_raw(filename,bad_ch,stream_PSG=False,dtype=None,psg=True):
 
-    ## Load raw file    
+    ## Channels needed
     
-    # Load metadata of full raw file in EDF format; not yet preloading data to save memory
-    raw = mne.io.read_raw_edf(filename, preload=False)
+    # PSG & EEG channel subsets
+    psg_ch = ['C3','C4','LEOG','REOG','LEMG','REMG']
+    eeg_ch = ['PO3','PO4','POz','O1','O2','Oz']
     
-    # Rename channels whose original names needed to match Neurofax headbox
-    raw.rename_channels({'Cz':'Oz', 'P3':'PO3', 'P4':'PO4', 'Pz':'POz', 'PG1':'LEOG', 'PG2':'REOG', 'T1':'LEMG', 'T2':'REMG'})
+    # Mastoid reference: average of both, unless one of the 2 channels is marked as bad
+    if 'A1' in bad_ch:
+        ref_ch = ['A2']
+    elif 'A2' in bad_ch:
+        ref_ch = ['A1']
+    else:
+        ref_ch = ['A1','A2']
     
-    # Mark bad channels, if any
-    raw.info['bads'] = bad_ch
+    # Names of these channels in the EDF file (before renaming)
+    edf_names = {new:old for old, new in channel_renames.items()}
+    include = [edf_names.get(ch, ch) for ch in (psg_ch + eeg_ch + ref_ch if psg and not stream_PSG else eeg_ch + ref_ch)]
     
     
-    ## PSG channels
+    ## Load raw file    
     
     # Add an exception catcher if something fails (e.g., memory overload)
     try:
     
-        # Make a copy of the raw object
-        raw_PSG = raw.copy()
+        # Load raw file in EDF format into memory, once, decoding only the channels needed; PSG and EEG channels are both derived from this data
+        raw = mne.io.read_raw_edf(filename, include=include, preload=True)
         
-        # Load data into memory
-        raw_PSG.load_data()
+        # Rename channels whose original names needed to match Neurofax headbox
+        raw.rename_channels({old:new for old, new in channel_renames.items() if old in raw.ch_names})
         
-        # Downsample to 100 Hz for faster computation; assumed for spectrogram
-        raw_PSG.resample(100) 
+        # Mark bad channels, if any (among the channels loaded)
+        raw.info['bads'] = [ch for ch in bad_ch if ch in raw.ch_names]
         
-        # Apply band-pass filter
-        raw_PSG.filter(l_freq=0.1, h_freq=45)
+        # Re-reference channels to mastoid reference; once, for PSG and EEG
+        raw.set_eeg_reference(ref_channels=ref_ch)
+            
+    except:
         
-        # Re-reference channels to mastoid average, unless one of the 2 channels is marked as bad
-        if 'A1' in bad_ch:
-            raw_PSG.set_eeg_reference(ref_channels=['A2'])
-        elif 'A2' in bad_ch:
-            raw_PSG.set_eeg_reference(ref_channels=['A1'])
-        else:
-            raw_PSG.set_eeg_reference(ref_channels=['A1','A2'])
+        print('Raw object could not be created properly!')
+        
+        return None, None
+    
+    
+    ## PSG channels
+    
+    # Add an exception catcher if something fails (e.g., memory overload)
+    try:
         
-        # Get the channel subset for PSG
-        raw_PSG.pick(['C3','C4','LEOG','REOG','LEMG','REMG'])
+        # Skip PSG channels, if not needed
+        if not psg:
+            raw_PSG = None
         
-        # Correctly label EOG and EMG channels
-        raw_PSG.set_channel_types({'LEOG':'eog', 'REOG':'eog', 'LEMG':'emg', 'REMG':'emg'})
+        # Stream PSG channels from file, at 100 Hz & band-pass filtered in one pass; EOG and EMG channels already labelled
+        elif stream_PSG:
+            raw_PSG = load_PSG_stream(filename, bad_ch)
+            raw_PSG.set_meas_date(raw.info['meas_date'])
+            raw_PSG.set_annotations(raw.annotations)
+        
+        else:
+            
+            # Copy only the PSG channel subset into a new raw object
+            psg_picks = mne.pick_channels(raw.ch_names, psg_ch, ordered=True)
+            raw_PSG = mne.io.RawArray(raw.get_data(picks=psg_picks), mne.pick_info(raw.info, psg_picks), verbose=False)
+            raw_PSG.set_annotations(raw.annotations)
+            
+            # Downsample to 100 Hz for faster computation; assumed for spectrogram
+            raw_PSG.resample(100) 
+            
+            # Apply band-pass filter
+            raw_PSG.filter(l_freq=0.1, h_freq=45)
+            
+            # Correctly label EOG and EMG channels
+            raw_PSG.set_channel_types({'LEOG':'eog', 'REOG':'eog', 'LEMG':'emg', 'REMG':'emg'})
         
     except:
         
@@ -99,23 +145,13 @@ def load_raw(filename,bad_ch):
     
     # Add an exception catcher if something fails (e.g., memory overload)
     try:
-    
-        # Make a copy of the raw object
-        raw_EEG = raw.copy()
-        
-        # Load data into memory
-        raw_EEG.load_data()
         
-        # Re-reference channels to mastoid average, unless one of the 2 channels is marked as bad
-        if 'A1' in bad_ch:
-            raw_EEG.set_eeg_reference(ref_channels=['A2'])
-        elif 'A2' in bad_ch:
-            raw_EEG.set_eeg_reference(ref_channels=['A1'])
-        else:
-            raw_EEG.set_eeg_reference(ref_channels=['A1','A2'])
+        # Get channel subset for EEG, in place; data of all other channels is released
+        raw_EEG = raw.pick(eeg_ch)
         
-        # Get channel subset for EEG
-        raw_EEG.pick(['PO3','PO4','POz','O1','O2','Oz'])
+        # Convert data type, if requested (PSG data is small and stays float64, as expected by YASA)
+        if dtype is not None:
+            raw_EEG._data = raw_EEG._data.astype(dtype, copy=False)
     
     except:
         
@@ -127,6 +163,238 @@ def load_raw(filename,bad_ch):
 
 
 
+# %% Class: TriggerTrain
+
+"""
+    Compact 40 Hz trigger train: stores the 1 Hz "real" triggers only, the 40 Hz triggers following each of them are implicit.
+    Each entry i holds the triggers anchors[i] + k*interval for k in [first[i], stop[i]); 
+    entries are split or trimmed when triggers are excluded, so any trigger subset of the original 40 Hz train can be represented.
+    Behaves like an array of trigger data points where needed (np.asarray, len, iteration).
+    
+    Input
+    ----------
+    anchors : array
+    Data points of the 1 Hz triggers, in chronological order
+    
+    first : array
+    Index of the first 40 Hz trigger kept per anchor (default: all 0)
+    
+    stop : array
+    Index after the last 40 Hz trigger kept per anchor (default: all n_sub)
+    
+    n_sub : int
+    Nr. of 40 Hz triggers per 1 Hz trigger (default: 40)
+    
+    interval : int
+    Nr. of data points between 40 Hz triggers (default: 25 ms at 1000 Hz)
+    
+    Methods
+    -------
+    from_1Hz(triggers_1Hz, extra_trigger=True) : build train from 1 Hz triggers, each followed by 39 triggers 25 ms apart; optionally one extra trigger 25 ms after the last one
+    samples : materialize all trigger data points as an array
+    error_rate() : percentage of triggers not 25 ms apart
+    count_between(starts, ends) : nr. of triggers t with start <= t <= end, per window
+    nearest_index(points) : index of the trigger closest to each data point
+    slice_samples(start, end) / slice_minutes(start_min, end_min, sfreq) : triggers within a window
+    exclude(start, end) : remove triggers between the triggers closest to start and end
+    exclude_windows(windows) : exclude several windows at once, given as (start, end) pairs
+    concatenate(trains, offsets) : merge trains of consecutive recordings, shifting each by its offset
+
+"""
+
+class TriggerTrain:
+    
+    def __init__(self, anchors, first=None, stop=None, n_sub=40, interval=25):
+        
+        self.anchors = np.asarray(anchors, dtype=np.int64)
+        self.n_sub = n_sub
+        self.interval = interval
+        
+        # Range of 40 Hz triggers kept per anchor; uint8 is enough for up to 255 triggers per anchor
+        self.first = np.zeros(len(self.anchors), dtype=np.uint8) if first is None else np.asarray(first, dtype=np.uint8)
+        self.stop = np.full(len(self.anchors), n_sub, dtype=np.uint8) if stop is None else np.asarray(stop, dtype=np.uint8)
+        
+        # Nr. of triggers before each entry, for index lookups
+        counts = self.stop.astype(np.int64) - self.first
+        self._cum = np.concatenate(([0], np.cumsum(counts)))
+        
+        # First trigger per entry; binary search on these requires entries in chronological order, without overlap
+        self._starts = self.anchors + self.first.astype(np.int64) * interval
+        last = self.anchors + (self.stop.astype(np.int64) - 1) * interval
+        self._sorted = bool(np.all(last[:-1] < self._starts[1:]))
+        self._sorted_samples = None
+    
+    
+    @classmethod
+    def from_1Hz(cls, triggers_1Hz, extra_trigger=True, n_sub=40, interval=25):
+        
+        anchors = np.asarray(triggers_1Hz, dtype=np.int64)
+        first = np.zeros(len(anchors), dtype=np.uint8)
+        stop = np.full(len(anchors), n_sub, dtype=np.uint8)
+        
+        # Trigger 25 ms after the last one, as produced by the original loop-based upsampling: single-trigger entry; initialization value 0 if no trigger was found
+        if extra_trigger:
+            anchors = np.append(anchors, anchors[-1] + n_sub*interval if len(anchors) > 0 else 0)
+            first = np.append(first, 0)
+            stop = np.append(stop, 1)
+        
+        return cls(anchors, first, stop, n_sub, interval)
+    
+    
+    def __len__(self):
+        
+        return int(self._cum[-1])
+    
+    
+    @property
+    def samples(self):
+        
+        # Full 40 Hz grid per anchor, keep only triggers in range of each entry
+        k = np.arange(self.n_sub)
+        grid = self.anchors[:, None] + k[None, :] * self.interval
+        keep = (k[None, :] >= self.first[:, None]) & (k[None, :] < self.stop[:, None])
+        
+        return grid[keep]
+    
+    
+    def __array__(self, dtype=None, copy=None):
+        
+        return self.samples if dtype is None else self.samples.astype(dtype)
+    
+    
+    def __iter__(self):
+        
+        return iter(self.samples)
+    
+    
+    @property
+    def nbytes(self):
+        
+        return self.anchors.nbytes + self.first.nbytes + self.stop.nbytes
+    
+    
+    def error_rate(self):
+        
+        # Triggers within an entry are 25 ms apart by construction; compare last trigger of each entry to first of next one
+        last = self.anchors + (self.stop.astype(np.int64) - 1) * self.interval
+        n_errors = np.count_nonzero(self._starts[1:] - last[:-1] != self.interval)
+        
+        return n_errors / len(self) * 100 if len(self) > 0 else 0
+    
+    
+    def _count_le(self, points):
+        
+        # Nr. of triggers <= each data point
+        points = np.floor(np.asarray(points)).astype(np.int64)
+        
+        if not self._sorted: # fallback for overlapping entries: binary search on sorted materialized triggers
+            if self._sorted_samples is None:
+                self._sorted_samples = np.sort(self.samples)
+            return np.searchsorted(self._sorted_samples, points, side='right')
+        
+        # Last entry whose first trigger is <= data point
+        i = np.searchsorted(self._starts, points, side='right') - 1
+        i_valid = np.maximum(i, 0)
+        
+        # Nr. of triggers of that entry up to data point, plus all triggers of previous entries
+        k = (points - self.anchors[i_valid]) // self.interval + 1
+        n_in_entry = np.clip(k, self.first[i_valid], self.stop[i_valid]) - self.first[i_valid]
+        
+        return np.where(i >= 0, self._cum[i_valid] + n_in_entry, 0)
+    
+    
+    def count_between(self, starts, ends):
+        
+        return self._count_le(ends) - self._count_le(np.ceil(np.asarray(starts)) - 1)
+    
+    
+    def _value_at(self, idx):
+        
+        # Trigger data point at index (in train order)
+        j = np.searchsorted(self._cum, idx, side='right') - 1
+        k = self.first[j].astype(np.int64) + idx - self._cum[j]
+        
+        return self.anchors[j] + k * self.interval
+    
+    
+    def nearest_index(self, points):
+        
+        points = np.asarray(points)
+        
+        if not self._sorted: # fallback: scan, as in the original implementation
+            samples = self.samples
+            return np.array([abs(samples - p).argmin() for p in np.atleast_1d(points)]).reshape(points.shape)
+        
+        # Candidates: last trigger < data point & first trigger >= data point; on ties, the earlier one (as argmin)
+        r = self._count_le(np.ceil(points) - 1)
+        before = np.clip(r - 1, 0, len(self) - 1)
+        after = np.clip(r, 0, len(self) - 1)
+        take_before = abs(points - self._value_at(before)) <= abs(self._value_at(after) - points)
+        
+        return np.where(take_before, before, after)
+    
+    
+    def _take_range(self, i0, i1):
+        
+        # New train with triggers at indices [i0, i1)
+        i0 = int(np.clip(i0, 0, len(self)))
+        i1 = int(np.clip(i1, i0, len(self)))
+        if i1 == i0:
+            return TriggerTrain([], n_sub=self.n_sub, interval=self.interval)
+        
+        # First & last entry involved
+        j0 = np.searchsorted(self._cum, i0, side='right') - 1
+        j1 = np.searchsorted(self._cum, i1 - 1, side='right') - 1
+        
+        first = self.first[j0:j1+1].copy()
+        stop = self.stop[j0:j1+1].copy()
+        first[0] = int(first[0]) + i0 - self._cum[j0]
+        stop[-1] = int(self.first[j1]) + i1 - self._cum[j1]
+        
+        return TriggerTrain(self.anchors[j0:j1+1], first, stop, self.n_sub, self.interval)
+    
+    
+    def slice_samples(self, start, end):
+        
+        return self._take_range(self._count_le(np.ceil(start) - 1), self._count_le(end))
+    
+    
+    def slice_minutes(self, start_min, end_min, sfreq=1000):
+        
+        return self.slice_samples(start_min * 60 * sfreq, end_min * 60 * sfreq)
+    
+    
+    def exclude(self, start, end):
+        
+        # Keep triggers before the one closest to start, and from the one closest to end onwards
+        i_start, i_end = self.nearest_index([start, end])
+        
+        return TriggerTrain.concatenate([self._take_range(0, i_start), self._take_range(i_end, len(self))])
+    
+    
+    def exclude_windows(self, windows):
+        
+        # Exclude windows from last to first, so that earlier windows are resolved on the same triggers as when done alone
+        train = self
+        for start, end in sorted(windows, reverse=True):
+            train = train.exclude(start, end)
+        
+        return train
+    
+    
+    @staticmethod
+    def concatenate(trains, offsets=None):
+        
+        if offsets is None:
+            offsets = [0] * len(trains)
+        
+        return TriggerTrain(np.concatenate([t.anchors + o for t, o in zip(trains, offsets)]),
+                            np.concatenate([t.first for t in trains]),
+                            np.concatenate([t.stop for t in trains]),
+                            trains[0].n_sub, trains[0].interval)
+
+
+
 # %% Function: import_triggers
 
 """
@@ -141,25 +409,32 @@ def load_raw(filename,bad_ch):
     Path to annotations of experimental session 02 or 03 
     
     raw_EEG : MNE raw object
-    Output of load_raw()
+    Output of load_raw(); optional, only used to drop triggers beyond the end of the recording and to get the sampling rate
+    
+    sfreq : int
+    Sampling rate of the EEG data in Hz, if raw_EEG is not given (default: 1000)
     
     Output
     -------
-    triggers_s01 : array
-    Array containing trigger data points from session 01
+    triggers_s01 : TriggerTrain
+    Trigger data points from session 01
     
-    triggers_s02 : array
-    Array containing trigger data points from session 02
+    triggers_s02 : TriggerTrain
+    Trigger data points from session 02
     
-    triggers_s03 : array
-    Array containing trigger data points from session 03
+    triggers_s03 : TriggerTrain
+    Trigger data points from session 03
 
 """
 
-def import_triggers(file_wake, file_sleep, raw_EEG):
+def import_triggers(file_wake, file_sleep, raw_EEG=None, sfreq=1000):
     
-    # Clone raw object, just a placeholder to access annotations
-    raw_copy = raw_EEG.copy()
+    # Get sampling rate & recording length (in sec) from raw object, if available; no EEG data is accessed
+    if raw_EEG is not None:
+        sfreq = raw_EEG.info['sfreq']
+        len_recording = len(raw_EEG) / sfreq
+    else:
+        len_recording = np.inf
     
     # Get list of conditions (1 for control, 2 for experimental)
     if file_wake == None:
@@ -172,45 +447,23 @@ def import_triggers(file_wake, file_sleep, raw_EEG):
     
     for cond in range(len(conditions)):
         
-        # Import annotations from EDF file
-        annotations = mne.read_annotations(conditions[cond], sfreq=1000)
-
-        # Add to raw object (necessary for next step)
-        raw_copy.set_annotations(annotations, emit_warning=False)  
-
-        # Create events from trigger annotations only
-        events, _ = mne.events_from_annotations(raw_copy, event_id={'DC trigger 9':1}) 
+        # Import annotations from TAL records of the EDF file
+        onset, _, description = read_annotations_edf(conditions[cond])
+        
+        # Keep onsets of trigger annotations only, within the recording
+        onset = onset[(description == 'DC trigger 9') & (onset <= len_recording)]
+        
+        # Convert onsets to data points, in chronological order
+        events = np.sort(np.round(onset * sfreq).astype(int))[:, None]
 
         # Access data points containing triggers
         # Ignoring first few triggers & last trigger
         triggers_1Hz = events[5:-1,0]
 
-        # Initialize trigger array
-        triggers = np.zeros((len(triggers_1Hz) * 40 + 1), dtype=int)
+        # Upsample to 40 Hz as compact trigger train, display trigger error rate
+        triggers = TriggerTrain.from_1Hz(triggers_1Hz)
+        print("Trigger error rate:", round(triggers.error_rate(), 2), "%")
 
-        for i in range(len(triggers_1Hz)):
-            
-            # Add "real" trigger
-            triggers[i*40] = triggers_1Hz[i]
-            
-            # Add 39 following triggers
-            for j in range(1,41):
-                
-                triggers[i*40+j] = triggers_1Hz[i] + j*25
-                
-                
-        ## Display percentage of triggers that are not 25 ms apart
-        
-        # Compute differential of trigger list
-        trig_diff = np.diff(triggers)
-
-        # Get triggers not 25 ms apart
-        errors = trig_diff[trig_diff != 25]
-
-        # Compute & display error rate
-        error_rate = len(errors) / len(triggers) * 100
-        print("Trigger error rate:", round(error_rate, 2), "%")
-    
         
         ## Store triggers per condition
         
@@ -241,593 +494,2143 @@ def import_triggers(file_wake, file_sleep, raw_EEG):
         
     
 
-# %% Function: import_triggers_DC
+# %% Function: detect_triggers_DC
 
 """
-    Import 1 Hz triggers from 1 session based on DC channel, digitally upsample to 40 Hz.
+    Detect 1 Hz triggers as threshold crossings in the DC channel.
     
     Input
     ----------
-    filename : str
-    Path to the EEG data file in EDF format
+    data_dc03 : array
+    Data from the DC03 channel, in mV
     
     threshold_mV : int
     Amplitude threshold at which a trigger should be detected, in mV
     
+    refractory : int
+    Nr. of data points skipped after each trigger, so the same trigger is not included twice (default: 900 ms)
+    
+    search_len : int
+    Nr. of data points after the crossing in which the max. amplitude is searched (default: 5 ms)
+    
+    return_crossings : bool
+    Also return the threshold crossings the triggers are based on (needed to carry the refractory period over data blocks)
+    
     Output
     -------
-    triggers : array
-    Array containing trigger data points from 1 session, extracted from DC input channel
+    triggers_1Hz : array
+    Array containing data points of all 1 Hz triggers detected
+    
+    crossings : array
+    Array containing the data points at which the threshold was crossed (only if return_crossings=True)
 
 """
 
-def import_triggers_DC(filename, threshold_mV):
+def detect_triggers_DC(data_dc03, threshold_mV, refractory=900, search_len=5, return_crossings=False):
     
-    # Access raw object
-    raw = mne.io.read_raw_edf(filename, preload=False)
+    # Work on 1 row of data
+    data_dc03 = np.ravel(data_dc03)
     
-    # Access data from DC03 channel, convert from Volts to milliVolts
-    data_dc03 = raw.get_data(['DC03']) * 1e3
     
-
-    ## Generate 1 Hz triggers based on DC03
-
-    # Initialize trigger array: at max. full night
-    triggers_1Hz = np.zeros(60*60*9, dtype=int)
-
-    i = 0
-    ctr = 0
-
-    while i < np.shape(data_dc03)[1]:
+    ## Find runs of data points above threshold
+    
+    # Boolean mask of data points above threshold, padded so that every run has a start and an end
+    above = np.concatenate(([False], data_dc03 > threshold_mV, [False]))
+    
+    # Rising edges mark run starts, falling edges run ends (exclusive)
+    edges = np.flatnonzero(np.diff(above.view(np.int8)))
+    run_starts = edges[0::2]
+    run_ends = edges[1::2]
+    
+    
+    ## Apply refractory period
+    
+    # Default: all runs are shorter than and at least as far apart as the refractory period, so each run start is 1 trigger
+    if np.all(run_ends - run_starts <= refractory) and np.all(np.diff(run_starts) >= refractory):
         
-        # If DC03 > threshold, add a trigger to array
-        if data_dc03[0,i] > threshold_mV:
-            
-            # Get index of data point with max. amplitude within range of 5 ms
-            max_amp_idx = np.argmax(data_dc03[0,i:i+5])
-                
-            triggers_1Hz[ctr] = int(i+max_amp_idx) # add index of relevant datapoint
-
-            # Increase counters
-            i += 900 # move 900 ms forward, so the same trigger is not included twice
-            ctr += 1
-            
-        # If no trigger was found, move to next data point
-        else:
-            
-            i += 1
-            
-    # Trim trigger array to include only triggers, not zeros
-    triggers_1Hz = triggers_1Hz[0:ctr-1] # -1 to remove last trigger, may be too close to recording end
-
-    # Initialize full trigger array
-    triggers = np.zeros((len(triggers_1Hz) * 40 + 1), dtype=int)
-
-    for i in range(len(triggers_1Hz)):
+        crossings = run_starts
+    
+    # Otherwise: greedy pass, jumping from one trigger to the first data point above threshold after the refractory period
+    else:
         
-        # Add "real" trigger
-        triggers[i*40] = triggers_1Hz[i]
+        crossings = []
+        i = run_starts[0] if len(run_starts) > 0 else len(data_dc03)
         
-        # Add 39 following triggers
-        for j in range(1,41):
+        while i < len(data_dc03):
             
-            triggers[i*40+j] = triggers_1Hz[i] + j*25
+            crossings.append(i)
             
+            # Run containing the first data point after the refractory period, if any
+            next_i = i + refractory
+            r = np.searchsorted(run_ends, next_i, side='right')
             
-    ## Display percentage of triggers that are not 25 ms apart
+            if r == len(run_starts): # no data above threshold left
+                break
+            
+            # Move to that data point if it is still above threshold, else to the start of the next run
+            i = max(next_i, run_starts[r])
+        
+        crossings = np.asarray(crossings, dtype=int)
     
-    # Compute differential of trigger list
-    trig_diff = np.diff(triggers)
-
-    # Get triggers not 25 ms apart
-    errors = trig_diff[trig_diff != 25]
-
-    # Compute & display error rate
-    error_rate = len(errors) / len(triggers) * 100
-    print("Trigger error rate:", round(error_rate, 2), "%")
+    
+    ## Get index of data point with max. amplitude within search range (truncated at recording end)
+    
+    window_idx = np.minimum(crossings[:, None] + np.arange(search_len)[None, :], len(data_dc03) - 1)
+    max_amp_idx = np.argmax(data_dc03[window_idx], axis=1)
+    
+    triggers_1Hz = (crossings + max_amp_idx).astype(int)
+    
+    
+    if return_crossings:
+        return triggers_1Hz, crossings
+    
+    return triggers_1Hz
 
 
-    return triggers
-    
-        
 
-# %% Function: score_sleep
+# %% Function: read_edf_header
 
 """
-    Source code: https://raphaelvallat.com/yasa/build/html/api.html
-
-    Use YASA package to automatically score sleep stages and compute PSG metrics.
+    Read the header of an EDF(+) file, without loading any data.
     
     Input
     ----------
-    raw_PSG : MNE raw object
-    Output of load_raw() for PSG channels
-    
-    raw_EEG : MNE raw object
-    Output of load_raw() for EEG channels
-    
-    bad_ch : list
-    Names of bad channels identified visually
+    filename : str
+    Path to the EEG data file in EDF format
     
-    path_demographics : str
-    Path to participant's demographics data file
-
     Output
     -------
-    hypnogram : array
-    Array containing epochs scored by YASA
-    
-    hypno_up : array
-    Upsampled hypnogram to match EEG data points
-    
-    uncertain_epochs : list
-    List of epoch indices scored with a certainty below 50 %
-        
-    sleep_stats : dict
-    Dictionary containing calculated PSG metrics
+    header : dict
+    Dictionary containing the header fields needed to decode data records: 
+    n_records, record_duration, header_bytes, record_len (nr. of 2-byte samples per data record), labels, units (scaling to Volts),
+    n_samples, offsets (position of each signal in a data record), cals & phys_offsets (digital to physical conversion)
 
 """
 
-def score_sleep(raw_PSG, raw_EEG, bad_ch, path_demographics):
-
-    ## Define input channels; right side as default, left side as backup
+def read_edf_header(filename):
     
-    # Central EEG (minimal requirement)
-    if 'C4' in bad_ch:
-        eeg = 'C3'
-    else:
-        eeg = 'C4'
+    with open(filename, 'rb') as f:
         
-    # EOG
-    if 'REOG' in bad_ch and 'LEOG' not in bad_ch: # if only LEOG is good
-        eog = 'LEOG'
-    elif 'REOG' in bad_ch and 'LEOG' in bad_ch: # if both EOG are bad
-        eog = None
-    else: # default: REOG
-        eog = 'REOG'
+        # Fixed part of the header (256 bytes)
+        fixed = f.read(256).decode('latin-1')
+        header_bytes = int(fixed[184:192])
+        n_records = int(fixed[236:244])
+        record_duration = float(fixed[244:252])
+        ns = int(fixed[252:256])
         
-    # EMG
-    if 'REMG' in bad_ch and 'LEMG' not in bad_ch: # if only LEMG is good
-        emg = 'LEMG'
-    elif 'REMG' in bad_ch and 'LEMG' in bad_ch: # if both EMG are bad
-        emg = None
-    else: # default: REMG
-        emg = 'REMG'
+        # Signal-specific part of the header (ns * 256 bytes), stored field by field
+        def read_field(n_bytes):
+            return [f.read(n_bytes).decode('latin-1').strip() for _ in range(ns)]
         
+        labels = read_field(16)
+        read_field(80) # transducer type
+        phys_dim = read_field(8)
+        phys_min = np.array(read_field(8), dtype=float)
+        phys_max = np.array(read_field(8), dtype=float)
+        dig_min = np.array(read_field(8), dtype=float)
+        dig_max = np.array(read_field(8), dtype=float)
+        read_field(80) # prefiltering
+        n_samples = np.array(read_field(8), dtype=int)
         
-    ## Demographic data
-    
-    # Load data from CSV file
-    demographics = pd.read_csv(path_demographics)
-    
-    # Extract age
-    age = demographics.age[0]
+    # Nr. of samples per data record, all signals
+    record_len = int(n_samples.sum())
     
-    # Extract sex, code as boolean for SleepStaging function
-    if demographics.sex[0] == 1: # sex = female
-        male = False
-    elif demographics.sex[0] == 2: # sex = male
-        male = True
-    else: # sex = 'intersex' or 'prefer not to say'
-        male = None
-        
-        
-    ## Automated sleep staging
+    # Nr. of data records may be missing (-1) in the header; infer from file size
+    if n_records < 0:
+        with open(filename, 'rb') as f:
+            f.seek(0, 2)
+            n_records = (f.tell() - header_bytes) // (2 * record_len)
     
-    # Create YASA object
-    if male is not None: # default: sex variable is defined as either female or male (only valid inputs in YASA)
-        sls = yasa.SleepStaging(raw_PSG, eeg_name=eeg, eog_name=eog, emg_name=emg, metadata=dict(age=age, male=male))
-    else: # alternative: run the algorithm without sex variable
-        sls = yasa.SleepStaging(raw_PSG, eeg_name=eeg, eog_name=eog, emg_name=emg, metadata=dict(age=age))
-        
-    # Predict the sleep stages
-    hypnogram = sls.predict()
+    # Conversion from physical dimension to Volts (same convention as MNE)
+    units = np.array([1e-6 if dim in ('uV', '\u00b5V', '\u03bcV', '\x83\xcaV') else 1e-3 if dim == 'mV' else 1 for dim in phys_dim])
     
-    # Convert "W" to 0, "N1" to 1, etc; 4 is REM
-    hypnogram = yasa.hypno_str_to_int(hypnogram)
+    # Conversion from digital values to physical values
+    cals = (phys_max - phys_min) / (dig_max - dig_min)
+    phys_offsets = phys_min - dig_min * cals
     
-    # Upsample hypnogram to match EEG data
-    hypno_up = yasa.hypno_upsample_to_data(hypnogram, sf_hypno=1/30, data=raw_EEG)
+    header = dict(n_records=n_records, record_duration=record_duration, header_bytes=header_bytes, record_len=record_len,
+                  labels=labels, units=units, n_samples=n_samples, offsets=np.concatenate(([0], np.cumsum(n_samples)[:-1])),
+                  cals=cals, phys_offsets=phys_offsets)
     
-    # Predicted probabilities of each sleep stage at each epoch
-    sls.predict_proba()
     
-    # Extract a confidence level (ranging from 0 to 1) for each epoch
-    confidence = sls.predict_proba().max(1)
-    
-    # Get list of uncertain epochs (below 50 % probability)
-    uncertain_epochs = confidence.loc[confidence < 0.5]
-    uncertain_epochs = list(uncertain_epochs.index)
-    print('\nStages scored;', len(uncertain_epochs), 'epochs out of', len(hypnogram), 'below 50 % probability')
-    
-    
-    ### Metrics & plot
-    
-    # Sleep statistics
-    sleep_stats = yasa.sleep_statistics(hypnogram, sf_hyp=1/30) # SR of hypnogram is one value every 30-seconds (staged epochs)
-    
-    # Upsample hypnogram to match data, for plot
-    hypno_plot = yasa.hypno_upsample_to_data(hypnogram, sf_hypno=1/30, data=raw_PSG)
-    
-    # Access data of central derivation channel used for prediction
-    data_plot = raw_PSG.get_data(picks=eeg)
-    
-    # Plot spectrogram for chosen EEG channel
-    # yasa.plot_spectrogram(data_plot[0], 100, hypno_plot, fmin=0.5, fmax=25)
+    return header
 
 
-    return hypnogram, hypno_up, uncertain_epochs, sleep_stats
-
 
-    
-# %% Function: linear_interpolation
+# %% Function: iter_edf_blocks
 
 """
-    Source code: https://github.com/JamesDowsettNeuroscience/flicker_analysis_code
-    
-    Remove electric artifacts from EEG data caused by LED on-off via linear interpolation.
+    Read selected signals of an EDF file block by block, decoding only those signals from the data records.
+    Memory use is bounded by the block size, not by the length of the recording.
     
     Input
     ----------
-    raw_EEG : MNE raw object
-    Output of load_raw() for EEG channels
+    filename : str
+    Path to the EEG data file in EDF format
     
-    triggers : array
-    1 row of triggers, i.e., data points at which a trigger occurred
+    ch_names : list
+    Names of the signals to read, as labelled in the EDF file; all need the same sampling rate
     
-    Output
+    block_records : int
+    Nr. of data records read per block (default: 600, i.e. 10 min for 1 s records)
+    
+    Output (generator)
     -------
-    raw_EEG : MNE raw object
-    Raw object with data now cleaned of the electric artifact
+    first_sample : int
+    Index of the first data point of the current block
+    
+    data : array
+    Data of the current block in Volts, shape (n_channels, n_samples)
 
 """
 
-def linear_interpolation(raw_EEG, triggers):
-        
-    # Access data from all channels in raw
-    data_interpolated = raw_EEG.get_data()
+def iter_edf_blocks(filename, ch_names, block_records=600):
     
-    # First timepoint in the averaged 25 ms segment affected by the artifact (0-24), due to LED ON
-    time_start_1 = -1
-    # Second timepoint in the averaged 25 ms segment affected by the artifact (0-24), due to LED OFF
-    time_start_2 = 11
-    # Length of the artifact in data points (1-24)
-    art_len = 4
-
-    # Run interpolation on all channels
-    for i in range(len(data_interpolated)):
+    # Access header
+    header = read_edf_header(filename)
     
-        # Loop through triggers
-        for trigger in triggers:
-            
-            # Define starting point 1 for interpolation of current segment
-            start_1 = trigger + time_start_1
-            
-            # Define end point 1 for interpolation of current segment
-            end_1 = trigger + time_start_1 + art_len
+    # Indices of the selected signals
+    idx = [header['labels'].index(ch) for ch in ch_names]
+    
+    # Nr. of samples per data record, must be the same for all selected signals
+    n_samples = header['n_samples'][idx]
+    if len(set(n_samples)) > 1:
+        raise ValueError('Signals ' + str(ch_names) + ' do not share the same sampling rate')
+    n_samples = int(n_samples[0])
+    
+    # Columns of the selected signals within a data record
+    columns = header['offsets'][idx][:, None] + np.arange(n_samples)[None, :]
+    
+    with open(filename, 'rb') as f:
+        
+        # Move to first data record
+        f.seek(header['header_bytes'])
+        
+        for first_record in range(0, header['n_records'], block_records):
             
-            # Replace real data points between start and end points of artifact with straight line (artifact 1)
-            data_interpolated[i,start_1:end_1+1] = np.linspace(data_interpolated[i,start_1], data_interpolated[i,end_1], num = art_len+1)
+            # Read block of data records as 16-bit integers
+            n_block = min(block_records, header['n_records'] - first_record)
+            records = np.fromfile(f, dtype='<i2', count=n_block * header['record_len']).reshape(n_block, header['record_len'])
             
-            # Define starting point 2 for interpolation of current segment
-            start_2 = trigger + time_start_2
+            # Decode selected signals only, shape (n_channels, n_block * n_samples)
+            data = records[:, columns].transpose(1, 0, 2).reshape(len(idx), -1).astype(float)
             
-            # Define end point 1 for interpolation of current segment
-            end_2 = trigger + time_start_2 + art_len
+            # Convert digital values to physical values, then to Volts
+            data *= header['cals'][idx][:, None]
+            data += header['phys_offsets'][idx][:, None]
+            data *= header['units'][idx][:, None]
             
-            # Replace real data points between start and end points of artifact with straight line (artifact 1)
-            data_interpolated[i,start_2:end_2+1] = np.linspace(data_interpolated[i,start_2], data_interpolated[i,end_2], num = art_len+1)
-        
-    # Replace data from all channels in raw object with cleaned data
-    raw_EEG._data = data_interpolated
-    
-    return raw_EEG
-    
+            yield first_record * n_samples, data
 
 
-# %% Function: select_annotations
-   
+
+# %% Function: read_annotations_edf
+
 """
-    Turn sleep stages into annotations, for PSD analyses.
+    Read annotations from the TAL records of an EDF+ file, without loading any signal data.
     
     Input
     ----------
-    raw_EEG : raw object
-    Output of load_raw() for EEG channels
+    filename : str
+    Path to the annotations file in EDF+ format
     
-    hypnogram : array
-    Output of score_sleep()
+    encoding : str
+    Encoding of the annotation texts (default: 'utf8')
     
-    uncertain_epochs : list
-    Output of score_sleep()
-
     Output
     -------
-    raw_EEG : MNE raw object
-    Processed data in MNE format (EEG channels) with selected stage annotations
-
-""" 
-
-def select_annotations(raw_EEG, hypnogram, uncertain_epochs):
-    
-    # Get length of scored recording in seconds (this excludes the last epoch if incomplete)
-    len_hypno = len(hypnogram) * 30 
+    onset : array
+    Onsets of all annotations in seconds, relative to the start of the first data record
     
-    # Onset of annotations: every 30 sec, for whole hypnogram
-    onset = range(0, len_hypno, 30)
+    duration : array
+    Durations of all annotations in seconds (0 if not given)
     
-    # Array with epoch onsets (in seconds) + all stages
-    all_stages = np.column_stack((np.asarray(onset),hypnogram))
+    description : array
+    Descriptions of all annotations
+
+"""
+
+def read_annotations_edf(filename, encoding='utf8'):
     
-    # Remove uncertain epochs
-    clean_stages = np.delete(all_stages,uncertain_epochs,axis=0)
+    # Access header
+    header = read_edf_header(filename)
     
-    # Create annotations with scored stages as markers
-    annotations = mne.Annotations(onset=clean_stages[:,0], duration=30, description=clean_stages[:,1])  
+    # Byte columns of the annotation signal(s) within a data record
+    idx = [i for i, label in enumerate(header['labels']) if label == 'EDF Annotations']
+    columns = np.concatenate([2 * header['offsets'][i] + np.arange(2 * header['n_samples'][i]) for i in idx])
     
-    # Add to raw object
-    raw_EEG.set_annotations(annotations, emit_warning=True)  
+    # Read all data records as bytes, keep only annotation signal(s)
+    with open(filename, 'rb') as f:
+        f.seek(header['header_bytes'])
+        records = np.fromfile(f, dtype=np.uint8, count=header['n_records'] * 2 * header['record_len'])
+    tals = records.reshape(header['n_records'], -1)[:, columns].tobytes()
     
+    # Parse time-stamped annotation lists (TALs): onset, optional duration, descriptions
+    pattern = b'([+-]\\d+\\.?\\d*)(\x15(\\d+\\.?\\d*))?(\x14.*?)\x14\x00'
     
-    return raw_EEG
+    onset = []
+    duration = []
+    description = []
+    offset = 0.0
     
+    for k, tal in enumerate(re.findall(pattern, tals)):
+        
+        descriptions = [d.decode(encoding) for d in tal[3].split(b'\x14')[1:] if d]
+        
+        # First TAL without description: time-keeping annotation, start of first data record
+        if k == 0 and len(descriptions) == 0:
+            offset = -float(tal[0])
+        
+        for d in descriptions:
+            onset.append(float(tal[0]) + offset)
+            duration.append(float(tal[2]) if tal[2] else 0.)
+            description.append(d)
     
     
-# %% Function: create_epochs
+    return np.array(onset, dtype=float), np.array(duration, dtype=float), np.array(description, dtype=str)
+
+
+
+# %% Function: load_PSG_stream
 
 """
-    Construct and select epochs for PSD analysis based on chosen stage.
+    Load the PSG channels from an EDF file as a 100 Hz, band-pass filtered raw object, without holding the full-rate data in memory.
+    Equivalent to the PSG part of load_raw() (mastoid reference, resampling to 100 Hz, 0.1 - 45 Hz band-pass filter), fused into one streaming pass:
+    blocks of the re-referenced PSG channels go through a polyphase decimator (scipy.signal.resample_poly) and the band-pass FIR filter designed by MNE,
+    both applied on overlapping chunks. Edges are mirrored as MNE does for filtering. 
+    Decimation uses an anti-aliasing FIR instead of MNE's FFT resampling, so the output differs slightly; see validate_PSG_stream().
     
     Input
     ----------
-    raw_EEG : MNE raw object
-	Output of select_annotations()
+    filename : str
+    Path to the EEG data file in EDF format
+        
+    bad_ch : list
+    Names of bad channels identified visually, as in load_raw()
     
-    all_triggers : array
-    Output of import_triggers(); merged trigger set or from one session
+    sfreq : int
+    Sampling frequency of the output in Hz, integer divisor of the recording's sampling frequency (default: 100)
+    
+    l_freq, h_freq : float
+    Edges of the band-pass filter in Hz (default: 0.1, 45)
+    
+    block_records : int
+    Nr. of EDF data records read per block, see iter_edf_blocks() (default: 600)
     
-    event_id : int
-    Stage to include in epoch selection. 0=wake, 1=N1, 2=N2, 3=N3, 4=REM
-
     Output
     -------
-    epochs : MNE epochs object
-	Selection of 30 s trials for PSD analyses
+    raw_PSG : MNE raw object
+    Processed data in MNE format - PSG channels, at 100 Hz
 
 """
 
-def create_epochs(raw_EEG, all_triggers, event_id):
+def load_PSG_stream(filename, bad_ch, sfreq=100, l_freq=0.1, h_freq=45, block_records=600):
     
-    # Turn annotations of currently selected stage into events
-    events, _ = mne.events_from_annotations(raw_EEG, event_id = {str(event_id):event_id}, verbose=False)
+    ## Channels needed
     
+    # PSG channel subset
+    psg_ch = ['C3','C4','LEOG','REOG','LEMG','REMG']
     
-    ## Select epochs with enough triggers
+    # Mastoid reference, unless one of the 2 channels is marked as bad (as in load_raw())
+    if 'A1' in bad_ch:
+        ref_ch = ['A2']
+    elif 'A2' in bad_ch:
+        ref_ch = ['A1']
+    else:
+        ref_ch = ['A1','A2']
+    
+    # EDF channel names
+    edf_names = {new:old for old, new in channel_renames.items()}
+    read_ch = [edf_names.get(ch, ch) for ch in psg_ch + ref_ch]
+    
+    # Bad channels are not re-referenced, as in raw.set_eeg_reference()
+    ref_to = np.array([ch not in bad_ch for ch in psg_ch])
+    
+    # Sampling rate of the recording & decimation factor
+    header = read_edf_header(filename)
+    n_record = header['n_samples'][header['labels'].index(read_ch[0])]
+    sfreq_in = n_record / header['record_duration']
+    down = int(round(sfreq_in / sfreq))
+    if down * sfreq != sfreq_in:
+        raise ValueError('Sampling frequency ' + str(sfreq_in) + ' Hz is not an integer multiple of ' + str(sfreq) + ' Hz')
+    
+    # Nr. of output data points, rounded as in MNE
+    n_total = int(round(header['n_records'] * n_record / down))
     
-    # Define minimal nr. of triggers required for a stimulation epoch (40 Hz, 25 sec)
-    min_n_triggers = 40 * 25
     
-    # Initialize list of non-stim epochs
-    not_stim = []
+    ## Filters
     
-    # Loop over events
-    for e in range(len(events)):
+    # Decimation: resample_poly() uses a FIR filter reaching 10 * down input points on each side; 
+    # chunks overlap by this margin, so each chunk gives the same output as the whole recording at once
+    margin = 10 * down
+    
+    # Band-pass: same FIR filter as raw.filter(), applied with zero phase (centered); it reaches half its length on each side
+    band_filter = mne.filter.create_filter(None, sfreq, l_freq, h_freq, verbose=False)
+    half_len = (len(band_filter) - 1) // 2
+    
+    
+    ## Decimation & band-pass, chunk by chunk
+    
+    # Buffers: input not yet decimated, decimated data not yet filtered
+    pending = None
+    decimated = np.zeros((len(psg_ch), 0))
+    mirrored = False
+    n_decimated = 0
+    filtered = []
+    
+    def decimate(pending, final=False):
         
-        # Get epoch start (data point)
-        epoch_start = events[e,0]
+        # Outputs whose decimation neighborhood is fully available (all remaining outputs at the end, last data points mirrored)
+        if final:
+            pending = np.concatenate((pending, 2 * pending[:, -1:] - pending[:, -2:-margin-2:-1], np.zeros((len(psg_ch), down))), axis=1)
+        n_out = max(0, (pending.shape[1] - 2 * margin) // down)
+        chunk = scipy.signal.resample_poly(pending[:, :n_out*down + 2*margin], 1, down, axis=1)[:, margin//down:margin//down+n_out]
         
-        # Define epoch end after 30 sec, factoring in sample rate
-        epoch_end = int(epoch_start + raw_EEG.info['sfreq'] * 30)
+        return chunk, pending[:, n_out*down:]
     
-        # Get all triggers recorded between epoch start & end, if any
-        epoch_triggers = [t for t in all_triggers if t >= epoch_start and t <= epoch_end]
+    def band_pass(decimated, mirrored, new, final=False):
         
-        # Get nr. of triggers in this epoch
-        n_epoch_triggers = len(epoch_triggers)
+        decimated = np.concatenate((decimated, new), axis=1)
         
-        # If the epoch does not contain enough triggers, mark for removal
-        if n_epoch_triggers < min_n_triggers:
-            
-            not_stim.append(e) # add to list of non-stim epochs
-            
-    # Remove all epochs without a sufficient nr. of triggers from events
-    events_clean = np.delete(events, not_stim, axis=0)
+        # Mirror the first data points before the recording, as MNE does (once enough data is available)
+        if not mirrored:
+            if decimated.shape[1] <= half_len and not final:
+                return np.zeros((len(psg_ch), 0)), decimated, mirrored
+            decimated = np.concatenate((2 * decimated[:, :1] - decimated[:, half_len:0:-1], decimated), axis=1)
+            mirrored = True
+        
+        # Mirror the last data points after the recording
+        if final:
+            decimated = np.concatenate((decimated, 2 * decimated[:, -1:] - decimated[:, -2:-half_len-2:-1]), axis=1)
+        
+        # Outputs whose filter neighborhood is fully available; keep the overlap for the next chunk
+        if decimated.shape[1] < len(band_filter):
+            return np.zeros((len(psg_ch), 0)), decimated, mirrored
+        chunk = scipy.signal.oaconvolve(decimated, band_filter[None, :], mode='valid', axes=1)
+        
+        return chunk, decimated[:, chunk.shape[1]:], mirrored
     
+    for _, data in iter_edf_blocks(filename, read_ch, block_records):
+        
+        # Re-reference to mastoids, then drop reference channels
+        data[:len(psg_ch)][ref_to] -= data[len(psg_ch):].mean(axis=0)
+        data = data[:len(psg_ch)]
+        
+        # Mirror the first data points before the recording, to avoid edge effects of decimation
+        if pending is None:
+            pending = 2 * data[:, :1] - data[:, margin:0:-1]
+        pending = np.concatenate((pending, data), axis=1)
+        del data
+        
+        new, pending = decimate(pending)
+        n_decimated += new.shape[1]
+        chunk, decimated, mirrored = band_pass(decimated, mirrored, new)
+        filtered.append(chunk)
     
-    ## Create epochs object
+    # Flush: last data points of the recording, as many as MNE's resampling gives
+    new, pending = decimate(pending, final=True)
+    chunk, decimated, mirrored = band_pass(decimated, mirrored, new[:, :n_total - n_decimated], final=True)
+    filtered.append(chunk)
     
-    epochs = mne.Epochs(
-        raw_EEG,
-        events=events_clean,
-        tmin=0, # start trials at beginning of scored epochs
-        tmax=30, # end trials at end of scored epochs
-        reject=dict(eeg = 0.001),  # trial rejection criterion: 1 mV peak to peak
-        baseline=None,
-        verbose=False
-    )
     
+    ## Raw object
     
-    return epochs
+    # Channel types as in load_raw(); bad channels among PSG channels
+    ch_types = {'LEOG':'eog', 'REOG':'eog', 'LEMG':'emg', 'REMG':'emg'}
+    info = mne.create_info(psg_ch, sfreq, [ch_types.get(ch, 'eeg') for ch in psg_ch])
+    info['bads'] = [ch for ch in bad_ch if ch in psg_ch]
+    
+    raw_PSG = mne.io.RawArray(np.concatenate(filtered, axis=1), info, verbose=False)
+    
+    
+    return raw_PSG
 
 
 
-# %% Function: compute_PSD
-"""
-    Source code: https://mne.tools/stable/auto_tutorials/time-freq/50_ssvep.html
+# %% Function: validate_PSG_stream
 
-    Compute PSD spectra and SNR values for current stage.
+"""
+    Tolerance test of load_PSG_stream() against the PSG output of load_raw() (MNE resampling & filtering), for 1 recording.
+    Both outputs are compared on the features sleep staging relies on: yasa.SleepStaging band-pass filters the signals to 0.4 - 30 Hz 
+    and uses per-epoch amplitude and band powers. Sample-wise comparison is not meaningful: MNE's FFT resampling pads the recording 
+    to a fast FFT length, which can shift the signal by a fraction of a sample, depending on the length of the recording.
+    The first and last epochs are excluded, as both outputs are dominated by the transients of the 0.1 Hz high-pass filter there.
     
     Input
     ----------
-    epochs : MNE epochs object
-    Output of select_epochs()
+    filename : str
+    Path to the EEG data file in EDF format
+        
+    bad_ch : list
+    Names of bad channels identified visually, as in load_raw()
+    
+    rtol : float
+    Maximal relative difference allowed for all features (default: 0.01, i.e. 1 %); observed differences are ~0.1 - 0.3 %
     
-    stage : int
-    Stage the epochs are assigned to (for plot title)
-
     Output
     -------
-    PSD_40Hz : int
-    Absolute PSD value at / near 40 Hz in dB
-    
-    SNR_40Hz : int
-    Absolute SNR value corresponding to PSD_40Hz
-    
-    PSD_spectrum : array
-    Average PSD spectrum across channels and epochs in current stage 
+    passed : bool
+    True if all features of all channels are within tolerance
     
-    SNR_spectrum : array
-    Average SNR spectrum of PSD values across channels and epochs in current stage
+    errors : pandas DataFrame
+    Per PSG channel (rows): maximal relative difference across epochs, per feature (columns: SD and band powers)
 
 """
 
-def compute_PSD(epochs, stage):
+def validate_PSG_stream(filename, bad_ch, rtol=0.01):
     
-    ## Compute PSD
+    # PSG data of both front-ends
+    raw_MNE, _ = load_raw(filename, bad_ch)
+    raw_stream = load_PSG_stream(filename, bad_ch)
     
-    # Get sampling rate
-    sfreq = epochs.info["sfreq"]
-    
-    # Compute average PSD spectra for this stage's epochs
-    # Note: only at this point do bad epochs get rejected
-    spectrum = epochs.compute_psd(
-        "welch",
-        n_fft=int(sfreq * 30), # length of FFT in seconds
-        tmin=0,
-        tmax=30,
-        fmin=0, # min. frequency to include in spectra (Hz)
-        fmax=100, # max. frequency to include in spectra (Hz)
-        window='hamming',
-        verbose=False
-    )
+    # Frequency bands as in yasa.SleepStaging
+    bands = {'sdelta':(0.4,1), 'fdelta':(1,4), 'theta':(4,8), 'alpha':(8,12), 'sigma':(12,16), 'beta':(16,30)}
     
-    # Access spectra
-    # psds: ndarray with shape (n_epochs, n_channels, n_freqs)
-    # freqs: array with all frequency levels
-    psds, freqs = spectrum.get_data(return_freqs=True)
+    features = []
     
-    # Find index of frequency bin closest to stimulation frequency (here, 40 Hz)
-    idx_bin_40Hz = np.argmin(abs(freqs - 40))
+    for raw in [raw_MNE, raw_stream]:
+        
+        # Filter as for sleep staging, split into 30 s epochs without first & last epoch
+        data = mne.filter.filter_data(raw.get_data(), raw.info['sfreq'], 0.4, 30, verbose=False)
+        epoch_len = int(30 * raw.info['sfreq'])
+        n_epochs = data.shape[1] // epoch_len
+        epochs = data[:, :n_epochs*epoch_len].reshape(data.shape[0], n_epochs, epoch_len)[:, 1:-1]
+        
+        # Features per channel & epoch: SD, band powers (Welch, 5 s windows)
+        freqs, psd = scipy.signal.welch(epochs, raw.info['sfreq'], nperseg=int(5 * raw.info['sfreq']), axis=-1)
+        powers = [psd[..., (freqs >= low) & (freqs < high)].sum(axis=-1) for low, high in bands.values()]
+        features.append(np.stack([epochs.std(axis=-1)] + powers, axis=-1))
     
-    # Find index of lower boundary for target frequency range (here, 39.5 Hz)
-    idx_bin_lower = np.argmin(abs(freqs - 39.5))
-
-    # Half length of target frequency range (in nr. of frequency bins)
-    bin_len = idx_bin_40Hz - idx_bin_lower
-
+    # Maximal relative difference across epochs
+    errors = pd.DataFrame(np.abs(features[1] / features[0] - 1).max(axis=1), index=raw_stream.ch_names, columns=['SD'] + list(bands))
+    passed = bool((errors <= rtol).all().all())
     
-    ## Compute SNR
     
-    # Nr. of neighboring frequency bins used to compute noise level, on each side (here, 'noise' = [38-39.5 Hz] + [40.5-42 Hz])
-    noise_n_neighbor_freqs = bin_len*3
+    return passed, errors
 
-    # Exclude immediately neighboring frequency bins in noise level calculation (here, 'signal' = [39.5-40.5 Hz])
-    noise_skip_neighbor_freqs = bin_len
-    
-    # Construct a kernel that calculates the mean of the neighboring frequencies
-    averaging_kernel = np.concatenate((
-        np.ones(noise_n_neighbor_freqs),
-        np.zeros(2 * noise_skip_neighbor_freqs + 1),
-        np.ones(noise_n_neighbor_freqs)))
-    averaging_kernel /= averaging_kernel.sum()
-
-    # Calculate the mean of the neighboring frequencies by convolving with the averaging kernel
-    mean_noise = np.apply_along_axis(
-        lambda psd_: np.convolve(psd_, averaging_kernel, mode='valid'),
-        axis=-1, arr=psds
-    )
 
-    # The mean is not defined on the edges so we will pad it with nas. The
-    # padding needs to be done for the last dimension only so we set it to
-    # (0, 0) for the other ones.
-    edge_width = noise_n_neighbor_freqs + noise_skip_neighbor_freqs
-    pad_width = [(0, 0)] * (mean_noise.ndim - 1) + [(edge_width, edge_width)]
-    mean_noise = np.pad(
-        mean_noise, pad_width=pad_width, constant_values=np.nan
-    )
-    
-    # Compute SNR spectra
-    # snrs: ndarray with shape (n_epochs, n_channels, n_freqs)
-    snrs = psds / mean_noise
+
+# %% Function: import_triggers_DC
+
+"""
+    Import 1 Hz triggers from 1 session based on DC channel, digitally upsample to 40 Hz.
     
+    Input
+    ----------
+    filename : str
+    Path to the EEG data file in EDF format
     
-    ## Spectra
+    threshold_mV : int
+    Amplitude threshold at which a trigger should be detected, in mV
     
-    freq_range = range(np.where(np.floor(freqs) == 0)[0][0], np.where(np.ceil(freqs) == 100)[0][0])
+    stream : bool
+    Read the DC03 channel block by block from the EDF file instead of loading it at once; bounds memory use by the block size
     
-    # PSD spectrum
-    psds_plot = 10 * np.log10(psds) # in dB
-    psds_mean = psds_plot.mean(axis=(0, 1))[freq_range] # across channels and epochs
-    psds_std = psds_plot.std(axis=(0, 1))[freq_range] # add standard deviation
+    block_records : int
+    Nr. of EDF data records per block, if stream=True (default: 600, i.e. 10 min for 1 s records)
     
-    # SNR spectrum
-    snr_mean = snrs.mean(axis=(0, 1))[freq_range] # across channels and epochs
-    snr_std = snrs.std(axis=(0, 1))[freq_range] # add standard deviation
+    Output
+    -------
+    triggers : TriggerTrain
+    Trigger data points from 1 session, extracted from DC input channel
+
+"""
+
+def import_triggers_DC(filename, threshold_mV, stream=False, block_records=600):
     
-    # Plot
-    # fig, axes = plt.subplots(2, 1, sharex='all', sharey='none', figsize=(8, 5))
+    ## Generate 1 Hz triggers based on DC03
     
-    # axes[0].plot(freqs[freq_range], psds_mean, color='b')
-    # axes[0].fill_between(
-    #     freqs[freq_range], psds_mean - psds_std, psds_mean + psds_std,
-    #     color='b', alpha=.2)
-    # axes[0].set(title="PSD spectrum, stage "+str(stage), ylabel='Power Spectral Density [dB]')
+    if not stream:
     
-    # axes[1].plot(freqs[freq_range], snr_mean, color='r')
-    # axes[1].fill_between(
-    #     freqs[freq_range], snr_mean - snr_std, snr_mean + snr_std,
-    #     color='r', alpha=.2)
-    # axes[1].set( title="SNR spectrum, stage "+str(stage), xlabel='Frequency [Hz]', ylabel='SNR', ylim=[-1, 50], xlim=[1, 100])
-    # fig.show()
+        # Access raw object, DC03 channel only
+        raw = mne.io.read_raw_edf(filename, include=['DC03'], preload=False)
+        
+        # Access data from DC03 channel, convert from Volts to milliVolts
+        data_dc03 = raw.get_data(['DC03']) * 1e3
     
+        # Detect all threshold crossings
+        triggers_1Hz = detect_triggers_DC(data_dc03, threshold_mV)
     
-    ## Get metrics
+    else:
+        
+        # Nr. of data points at the end of a block whose 5 ms search range reaches into the next block
+        n_tail = 5 - 1
+        
+        # Initialize list of triggers per block
+        triggers_blocks = []
+        
+        # Carry-over between blocks: last data points of previous block & their position, first data point left to scan
+        data_dc03 = np.zeros(0)
+        offset = 0
+        scan_from = 0
+        
+        for first_sample, block in iter_edf_blocks(filename, ['DC03'], block_records):
+            
+            # Append new block (converted from Volts to milliVolts) to data points carried over from previous block
+            data_dc03 = np.concatenate((data_dc03, block[0] * 1e3))
+            
+            # Detect threshold crossings from first data point left to scan, position relative to carried-over data
+            triggers_block, crossings = detect_triggers_DC(data_dc03[scan_from - offset:], threshold_mV, return_crossings=True)
+            triggers_block += scan_from
+            crossings += scan_from
+            
+            # Keep only crossings whose 5 ms search range is complete; the others are detected again with the next block
+            cutoff = offset + len(data_dc03) - n_tail
+            keep = crossings < cutoff
+            triggers_blocks.append(triggers_block[keep])
+            
+            # Continue after refractory period of last trigger kept, but not before the data carried over
+            if np.any(keep):
+                scan_from = max(crossings[keep][-1] + 900, cutoff)
+            else:
+                scan_from = max(scan_from, cutoff)
+            
+            # Carry last data points over to next block
+            data_dc03 = data_dc03[cutoff - offset:]
+            offset = cutoff
+            
+        # Detect crossings in data points left at recording end
+        triggers_block = detect_triggers_DC(data_dc03[scan_from - offset:], threshold_mV)
+        triggers_blocks.append(triggers_block + scan_from)
+        
+        # Merge triggers of all blocks
+        triggers_1Hz = np.concatenate(triggers_blocks)
     
-    # Absolute PSD value at 40 Hz in dB
+    # Remove last trigger, may be too close to recording end
+    triggers_1Hz = triggers_1Hz[0:-1]
+
+    # Upsample to 40 Hz as compact trigger train, display trigger error rate
+    triggers = TriggerTrain.from_1Hz(triggers_1Hz)
+    print("Trigger error rate:", round(triggers.error_rate(), 2), "%")
+
+
+    return triggers
+    
+        
+
+# %% Function: score_sleep
+
+"""
+    Source code: https://raphaelvallat.com/yasa/build/html/api.html
+
+    Use YASA package to automatically score sleep stages and compute PSG metrics.
+    
+    Input
+    ----------
+    raw_PSG : MNE raw object
+    Output of load_raw() for PSG channels
+    
+    raw_EEG : MNE raw object
+    Output of load_raw() for EEG channels
+    
+    bad_ch : list
+    Names of bad channels identified visually
+    
+    path_demographics : str
+    Path to participant's demographics data file
+    
+    upsample : bool
+    Optionally also return the hypnogram upsampled to the EEG data (one value per sample; large), default: False
+    
+    return_confidence : bool
+    Optionally also return the confidence of each scored epoch, default: False
+
+    Output
+    -------
+    hypnogram : array
+    Array containing epochs scored by YASA
+    
+    hypno_up : array
+    Upsampled hypnogram to match EEG data points; only if upsample=True, otherwise None 
+    (use get_trigger_stages() to look up stages at epoch resolution)
+    
+    uncertain_epochs : list
+    List of epoch indices scored with a certainty below 50 %
+        
+    sleep_stats : dict
+    Dictionary containing calculated PSG metrics
+    
+    confidence : array
+    Only if return_confidence=True; YASA confidence (0 to 1) of each epoch
+
+"""
+
+def score_sleep(raw_PSG, raw_EEG, bad_ch, path_demographics, upsample=False, return_confidence=False):
+
+    ## Define input channels; right side as default, left side as backup
+    
+    # Central EEG (minimal requirement)
+    if 'C4' in bad_ch:
+        eeg = 'C3'
+    else:
+        eeg = 'C4'
+        
+    # EOG
+    if 'REOG' in bad_ch and 'LEOG' not in bad_ch: # if only LEOG is good
+        eog = 'LEOG'
+    elif 'REOG' in bad_ch and 'LEOG' in bad_ch: # if both EOG are bad
+        eog = None
+    else: # default: REOG
+        eog = 'REOG'
+        
+    # EMG
+    if 'REMG' in bad_ch and 'LEMG' not in bad_ch: # if only LEMG is good
+        emg = 'LEMG'
+    elif 'REMG' in bad_ch and 'LEMG' in bad_ch: # if both EMG are bad
+        emg = None
+    else: # default: REMG
+        emg = 'REMG'
+        
+        
+    ## Demographic data
+    
+    # Load data from CSV file
+    demographics = pd.read_csv(path_demographics)
+    
+    # Extract age
+    age = demographics.age[0]
+    
+    # Extract sex, code as boolean for SleepStaging function
+    if demographics.sex[0] == 1: # sex = female
+        male = False
+    elif demographics.sex[0] == 2: # sex = male
+        male = True
+    else: # sex = 'intersex' or 'prefer not to say'
+        male = None
+        
+        
+    ## Automated sleep staging
+    
+    # Create YASA object
+    if male is not None: # default: sex variable is defined as either female or male (only valid inputs in YASA)
+        sls = yasa.SleepStaging(raw_PSG, eeg_name=eeg, eog_name=eog, emg_name=emg, metadata=dict(age=age, male=male))
+    else: # alternative: run the algorithm without sex variable
+        sls = yasa.SleepStaging(raw_PSG, eeg_name=eeg, eog_name=eog, emg_name=emg, metadata=dict(age=age))
+        
+    # Predict the sleep stages
+    hypnogram = sls.predict()
+    
+    # Convert "W" to 0, "N1" to 1, etc; 4 is REM
+    hypnogram = yasa.hypno_str_to_int(hypnogram)
+    
+    # Upsample hypnogram to match EEG data, only on request
+    hypno_up = yasa.hypno_upsample_to_data(hypnogram, sf_hypno=1/30, data=raw_EEG) if upsample else None
+    
+    # Predicted probabilities of each sleep stage at each epoch
+    sls.predict_proba()
+    
+    # Extract a confidence level (ranging from 0 to 1) for each epoch
+    confidence = sls.predict_proba().max(1)
+    
+    # Get list of uncertain epochs (below 50 % probability)
+    uncertain_epochs = confidence.loc[confidence < 0.5]
+    uncertain_epochs = list(uncertain_epochs.index)
+    print('\nStages scored;', len(uncertain_epochs), 'epochs out of', len(hypnogram), 'below 50 % probability')
+    
+    
+    ### Metrics & plot
+    
+    # Sleep statistics
+    sleep_stats = yasa.sleep_statistics(hypnogram, sf_hyp=1/30) # SR of hypnogram is one value every 30-seconds (staged epochs)
+    
+    # Upsample hypnogram to match data, for plot
+    hypno_plot = yasa.hypno_upsample_to_data(hypnogram, sf_hypno=1/30, data=raw_PSG)
+    
+    # Access data of central derivation channel used for prediction
+    data_plot = raw_PSG.get_data(picks=eeg)
+    
+    # Plot spectrogram for chosen EEG channel
+    # yasa.plot_spectrogram(data_plot[0], 100, hypno_plot, fmin=0.5, fmax=25)
+
+    
+    if return_confidence:
+        return hypnogram, hypno_up, uncertain_epochs, sleep_stats, confidence.to_numpy()
+
+    return hypnogram, hypno_up, uncertain_epochs, sleep_stats
+
+
+    
+# %% Function: get_trigger_stages
+
+"""
+    Look up the sleep stage of each trigger from the hypnogram at epoch resolution (30 s), 
+    without upsampling the hypnogram to the data. Same result as indexing the output of yasa.hypno_upsample_to_data() 
+    as of YASA 0.6 (samples after the last scored epoch get the last stage; newer YASA versions mark them as unscored instead).
+    
+    Input
+    ----------
+    triggers : array or TriggerTrain
+    Trigger data points
+    
+    hypnogram : array
+    Output of score_sleep(), one stage per 30 s epoch
+    
+    sfreq : int
+    Sampling frequency of the data the triggers refer to (default: 1000)
+    
+    uncertain_epochs : list
+    Optional epoch indices to mask; triggers in these epochs get stage -1 (default: None, no masking)
+    
+    Output
+    -------
+    trigger_stages : array
+    Stage of each trigger
+
+"""
+
+def get_trigger_stages(triggers, hypnogram, sfreq=1000, uncertain_epochs=None):
+    
+    # Access trigger data points as array
+    triggers = np.asarray(triggers)
+    hypnogram = np.asarray(hypnogram)
+    
+    # Epoch of each trigger; triggers after the last epoch belong to it
+    epochs = np.minimum(triggers // int(round(sfreq * 30)), len(hypnogram) - 1)
+    
+    # Stage of each trigger
+    trigger_stages = hypnogram[epochs]
+    
+    # Mask uncertain epochs
+    if uncertain_epochs is not None and len(uncertain_epochs) > 0:
+        trigger_stages = np.where(np.isin(epochs, uncertain_epochs), -1, trigger_stages)
+        
+        
+    return trigger_stages
+
+
+    
+# %% Function: get_analysis_windows
+
+"""
+    Get periods of the recording that enter PSD or SSVEP analyses, i.e. epochs scored as one of the analysed stages.
+    Includes uncertain epochs (used for SSVEP analyses); epochs with too few triggers are left to the trigger selection.
+    Each period is extended by the length of an SSVEP segment (24 data points), since segments of triggers in the last epoch
+    of a period reach into the next epoch.
+    
+    Input
+    ----------
+    hypnogram : array
+    Output of score_sleep()
+    
+    n_times : int
+    Nr. of data points in the recording
+    
+    sfreq : int
+    Sampling rate of the EEG data in Hz (default: 1000)
+    
+    stages : list
+    Stages analysed (default: W, N2, N3, REM)
+    
+    Output
+    -------
+    analysis_windows : array
+    Start and end data points (included) of analysed periods; consecutive epochs are merged, shape (n_periods, 2)
+
+"""
+
+def get_analysis_windows(hypnogram, n_times, sfreq=1000, stages=[0,2,3,4]):
+    
+    # Length of a scored epoch in data points
+    epoch_len = int(sfreq * 30)
+    
+    # Data points of an SSVEP segment after its trigger
+    segment_len = 24
+    
+    # Epochs of analysed stages, padded so that every run of epochs has a start and an end
+    analysed = np.concatenate(([False], np.isin(hypnogram, stages), [False]))
+    
+    # First and last epoch of each run of analysed epochs
+    edges = np.flatnonzero(np.diff(analysed.view(np.int8)))
+    first_epochs = edges[0::2]
+    last_epochs = edges[1::2] - 1
+    
+    # Convert to data points; epochs end at next epoch onset (included, as in create_epochs), 
+    # plus the segment of a trigger at the end of the last epoch
+    analysis_windows = np.column_stack((first_epochs * epoch_len, (last_epochs + 1) * epoch_len + segment_len))
+    
+    # Data points after the last full epoch are assigned the last stage, as in the upsampled hypnogram
+    if len(hypnogram) > 0 and analysed[-2]:
+        analysis_windows[-1, 1] = max(analysis_windows[-1, 1], n_times - 1)
+    
+    # Periods end within the recording
+    analysis_windows[:, 1] = np.minimum(analysis_windows[:, 1], n_times - 1)
+    
+    
+    return analysis_windows
+
+
+
+# %% Function: get_cleaned_epochs
+
+"""
+    Get the 30 s epochs whose data were cleaned of the LED artifact, for outputs covering the whole night (e.g. SSVEP trajectory, 40 Hz envelope)
+    when cleaning was restricted to the analysed periods. An epoch counts as cleaned if all data points it depends on lie within one cleaned period.
+    
+    Input
+    ----------
+    n_epochs : int
+    Nr. of epochs, e.g. length of the hypnogram
+    
+    n_times : int
+    Nr. of data points in the recording
+    
+    analysis_windows : array
+    Output of get_analysis_windows() used for cleaning; None if the whole recording was cleaned
+    
+    sfreq : int
+    Sampling rate of the EEG data in Hz (default: 1000)
+    
+    before, after : int
+    Nr. of data points before the epoch onset and after its end that the output also depends on 
+    (default: 0 and 24, i.e. SSVEP segments of triggers at the end of the epoch)
+    
+    Output
+    -------
+    cleaned : array
+    True for each epoch whose data were cleaned
+
+"""
+
+def get_cleaned_epochs(n_epochs, n_times, analysis_windows, sfreq=1000, before=0, after=24):
+    
+    # Whole recording cleaned
+    if analysis_windows is None:
+        return np.ones(n_epochs, dtype=bool)
+    
+    # Data points each epoch depends on, within the recording (first & last included)
+    epoch_len = int(sfreq * 30)
+    starts = np.maximum(np.arange(n_epochs) * epoch_len - before, 0)
+    ends = np.minimum((np.arange(n_epochs) + 1) * epoch_len + after, n_times - 1)
+    
+    # Last cleaned period starting before the epoch must also end after it
+    analysis_windows = np.asarray(analysis_windows).reshape(-1, 2)
+    idx = np.searchsorted(analysis_windows[:,0], starts, side='right') - 1
+    cleaned = (idx >= 0) & (ends <= analysis_windows[np.maximum(idx, 0), 1])
+    
+    
+    return cleaned
+
+
+
+# %% Function: linear_interpolation
+
+"""
+    Source code: https://github.com/JamesDowsettNeuroscience/flicker_analysis_code
+    
+    Remove electric artifacts from EEG data caused by LED on-off via linear interpolation.
+    
+    Input
+    ----------
+    raw_EEG : MNE raw object
+    Output of load_raw() for EEG channels
+    
+    triggers : array or TriggerTrain
+    1 row of triggers, i.e., data points at which a trigger occurred
+    
+    analysis_windows : array
+    Optional, output of get_analysis_windows(); only artifacts overlapping these periods are interpolated (default: all)
+    
+    dtype : numpy dtype
+    Optional data type of the cleaned data, e.g. np.float32 (default: None, data type of raw_EEG kept)
+    
+    Output
+    -------
+    raw_EEG : MNE raw object
+    Raw object with data now cleaned of the electric artifact
+
+"""
+
+def linear_interpolation(raw_EEG, triggers, analysis_windows=None, dtype=None):
+    
+    # Access trigger data points as array
+    triggers = np.asarray(triggers)
+    
+    # Convert data type, if requested
+    if dtype is not None:
+        raw_EEG._data = raw_EEG._data.astype(dtype, copy=False)
+        
+    # Access data from all channels in raw, without copying; modified in place
+    data_interpolated = raw_EEG._data
+    
+    # First timepoint in the averaged 25 ms segment affected by the artifact (0-24), due to LED ON
+    time_start_1 = -1
+    # Second timepoint in the averaged 25 ms segment affected by the artifact (0-24), due to LED OFF
+    time_start_2 = 11
+    # Length of the artifact in data points (1-24)
+    art_len = 4
+    
+    # Nr. of artifact windows interpolated at once; bounds memory of the index & value arrays
+    chunk_len = 2**16
+    
+    
+    ## Define artifact windows
+    
+    # Starting points of all windows, in order of processing: per trigger, artifact 1, then artifact 2
+    starts = np.stack((triggers + time_start_1, triggers + time_start_2), axis=1).ravel()
+    
+    # Keep only windows fully within the recording
+    starts = starts[(starts >= 0) & (starts + art_len < data_interpolated.shape[1])]
+    
+    # Keep only windows overlapping the analysed periods, if given: last period starting before window end must not end before window start
+    if analysis_windows is not None:
+        analysis_windows = np.asarray(analysis_windows).reshape(-1, 2)
+        idx = np.searchsorted(analysis_windows[:,0], starts + art_len, side='right') - 1
+        starts = starts[(idx >= 0) & (starts <= analysis_windows[np.maximum(idx, 0), 1])]
+    
+    # Windows sharing more than an end point with another window depend on the order of processing (e.g., at irregular trigger intervals)
+    order = np.argsort(starts, kind='stable')
+    too_close = np.diff(starts[order]) < art_len
+    overlap_sorted = np.zeros(len(starts), dtype=bool)
+    overlap_sorted[:-1] |= too_close
+    overlap_sorted[1:] |= too_close
+    overlap = np.zeros(len(starts), dtype=bool)
+    overlap[order] = overlap_sorted
+    
+    
+    ## Interpolate independent windows, all channels at once
+    
+    # Position of each data point within a window
+    steps = np.arange(art_len+1)
+    
+    for starts_chunk in np.array_split(starts[~overlap], max(1, int(np.ceil(np.sum(~overlap) / chunk_len)))):
+        
+        # Data points at start and end of each window, shape (n_channels, n_windows)
+        values_start = data_interpolated[:, starts_chunk]
+        values_end = data_interpolated[:, starts_chunk + art_len]
+        
+        # Straight line between start and end points, computed as in np.linspace
+        line = steps[None, None, :] * ((values_end - values_start) / art_len)[:, :, None] + values_start[:, :, None]
+        line[:, :, -1] = values_end
+        
+        # Replace real data points between start and end points of artifacts with straight lines
+        data_interpolated[:, starts_chunk[:, None] + steps[None, :]] = line
+    
+    
+    ## Interpolate overlapping windows one by one, in order of processing
+    
+    for start in starts[overlap]:
+        
+        data_interpolated[:, start:start+art_len+1] = np.linspace(data_interpolated[:, start], data_interpolated[:, start+art_len], num = art_len+1, axis=1)
+    
+    
+    return raw_EEG
+    
+
+
+# %% Function: template_subtraction
+
+"""
+    Remove electric artifacts from EEG data caused by LED on-off via subtraction of an average artifact template.
+    Alternative to linear_interpolation(): the trigger-locked average is computed per channel (and optionally per block of the night,
+    to follow drifts); within the artifact windows, its deviation from a straight line is the artifact template, which is subtracted
+    from every segment. Unlike interpolation, single-trial data within the artifact windows are kept.
+    
+    Input
+    ----------
+    raw_EEG : MNE raw object
+    Output of load_raw() for EEG channels
+    
+    triggers : array or TriggerTrain
+    1 row of triggers, i.e., data points at which a trigger occurred
+    
+    block_len : int
+    Optional, nr. of data points per block with its own template, e.g. 10 min = 600000 (default: 1 template for the whole recording)
+    
+    analysis_windows : array
+    Optional, output of get_analysis_windows(); only segments overlapping these periods are used and cleaned (default: all)
+    
+    Output
+    -------
+    raw_EEG : MNE raw object
+    Raw object with data now cleaned of the electric artifact
+
+"""
+
+def template_subtraction(raw_EEG, triggers, block_len=None, analysis_windows=None):
+    
+    # Access trigger data points as array
+    triggers = np.asarray(triggers)
+    
+    # Access data from all channels in raw, without copying; modified in place
+    data_cleaned = raw_EEG._data
+    
+    # First timepoint of the 25 ms segment relative to the trigger; covers both artifacts
+    seg_start = -1
+    # Length of the segment in data points
+    seg_len = 25
+    # First timepoints in the segment affected by the artifact, due to LED ON and LED OFF (as in linear_interpolation())
+    art_starts = [0, 12]
+    # Length of the artifact in data points (1-24)
+    art_len = 4
+    
+    # Nr. of segments processed at once; bounds memory of the segment arrays
+    chunk_len = 2**15
+    
+    
+    ## Define segments
+    
+    # Starting points of all segments, keep only those fully within the recording
+    starts = triggers + seg_start
+    starts = starts[(starts >= 0) & (starts + seg_len <= data_cleaned.shape[1])]
+    
+    # Keep only segments overlapping the analysed periods, if given
+    if analysis_windows is not None:
+        analysis_windows = np.asarray(analysis_windows).reshape(-1, 2)
+        idx = np.searchsorted(analysis_windows[:,0], starts + seg_len - 1, side='right') - 1
+        starts = starts[(idx >= 0) & (starts <= analysis_windows[np.maximum(idx, 0), 1])]
+    
+    # Block each segment belongs to
+    if block_len is None:
+        block_idx = np.zeros(len(starts), dtype=int)
+    else:
+        _, block_idx = np.unique(starts // block_len, return_inverse=True)
+    n_blocks = block_idx.max() + 1 if len(starts) > 0 else 0
+    
+    # Split segments into chunks
+    chunks = np.array_split(np.arange(len(starts)), max(1, int(np.ceil(len(starts) / chunk_len))))
+    
+    
+    ## Average trigger-locked segments per channel & block
+    
+    offsets = np.arange(seg_len)
+    templates = np.zeros((n_blocks, data_cleaned.shape[0], seg_len))
+    
+    for chunk in chunks:
+        
+        # Segments of this chunk, shape (n_segments, n_channels, seg_len)
+        segments = data_cleaned[:, starts[chunk][:, None] + offsets[None, :]].transpose(1, 0, 2)
+        
+        # Add to sum of corresponding block
+        np.add.at(templates, block_idx[chunk], segments)
+    
+    templates /= np.maximum(np.bincount(block_idx, minlength=n_blocks), 1)[:, None, None]
+    
+    
+    ## Artifact template: deviation of the average from a straight line within the artifact windows, 0 elsewhere
+    
+    artifact = np.zeros_like(templates)
+    
+    for art_start in art_starts:
+        
+        line = np.linspace(templates[..., art_start], templates[..., art_start+art_len], num = art_len+1, axis=-1)
+        artifact[..., art_start:art_start+art_len+1] = templates[..., art_start:art_start+art_len+1] - line
+    
+    # Timepoints affected by the artifact (start & end points are unchanged)
+    art_offsets = np.concatenate([np.arange(art_start+1, art_start+art_len) for art_start in art_starts])
+    artifact = artifact[..., art_offsets]
+    
+    
+    ## Subtract artifact template from all segments, chunk by chunk
+    
+    for chunk in chunks:
+        
+        idx = starts[chunk][:, None] + art_offsets[None, :]
+        data_cleaned[:, idx] -= artifact[block_idx[chunk]].transpose(1, 0, 2)
+    
+    
+    return raw_EEG
+
+
+
+# %% Function: check_sparse_interpolation
+
+"""
+    Check that linear interpolation restricted to the analysed periods (analysis_windows) gives the same analysed data as interpolating the whole recording:
+    all SSVEP segments of triggers in the analysed stages, and all analysed epochs. Runs both interpolations on copies of the data.
+    Note: not applicable to template_subtraction(), whose templates are averaged over the analysed segments only, by design.
+    
+    Input
+    ----------
+    raw_EEG : MNE raw object
+    Output of load_raw() for EEG channels, not yet cleaned
+    
+    triggers : array or TriggerTrain
+    1 row of triggers, i.e., data points at which a trigger occurred
+    
+    hypnogram : array
+    Output of score_sleep(), one stage per 30 s epoch
+    
+    stages : list
+    Stages analysed (default: W, N2, N3, REM)
+    
+    Output
+    -------
+    identical : bool
+    True if all analysed segments and epochs are identical
+    
+    n_segments_different : int
+    Nr. of analysed SSVEP segments that differ between both interpolations
+
+"""
+
+def check_sparse_interpolation(raw_EEG, triggers, hypnogram, stages=[0,2,3,4]):
+    
+    # Access trigger data points as array
+    triggers = np.asarray(triggers)
+    sfreq = raw_EEG.info['sfreq']
+    
+    # Interpolate whole recording & analysed periods only, on copies
+    windows = get_analysis_windows(hypnogram, raw_EEG.n_times, sfreq, stages)
+    data_full = linear_interpolation(raw_EEG.copy(), triggers)._data
+    data_sparse = linear_interpolation(raw_EEG.copy(), triggers, analysis_windows=windows)._data
+    
+    # Analysed SSVEP segments: triggers in analysed stages, segments within the recording
+    analysed = np.isin(get_trigger_stages(triggers, hypnogram, sfreq), stages) & (triggers + 25 <= raw_EEG.n_times)
+    starts = triggers[analysed]
+    different = np.zeros(len(starts), dtype=bool)
+    for first in range(0, len(starts), 2**16):
+        idx = starts[first:first+2**16, None] + np.arange(25)[None, :]
+        different[first:first+2**16] = (data_full[:, idx] != data_sparse[:, idx]).any(axis=(0, 2))
+    
+    # Analysed epochs: all data points of the analysed periods
+    epochs_identical = all(np.array_equal(data_full[:, start:end+1], data_sparse[:, start:end+1]) for start, end in windows)
+    
+    n_segments_different = int(different.sum())
+    identical = epochs_identical and n_segments_different == 0
+    
+    
+    return identical, n_segments_different
+
+
+
+# %% Function: select_annotations
+   
+"""
+    Turn sleep stages into annotations, for PSD analyses.
+    
+    Input
+    ----------
+    raw_EEG : raw object
+    Output of load_raw() for EEG channels
+    
+    hypnogram : array
+    Output of score_sleep()
+    
+    uncertain_epochs : list
+    Output of score_sleep()
+
+    Output
+    -------
+    raw_EEG : MNE raw object
+    Processed data in MNE format (EEG channels) with selected stage annotations
+
+""" 
+
+def select_annotations(raw_EEG, hypnogram, uncertain_epochs):
+    
+    # Get length of scored recording in seconds (this excludes the last epoch if incomplete)
+    len_hypno = len(hypnogram) * 30 
+    
+    # Onset of annotations: every 30 sec, for whole hypnogram
+    onset = range(0, len_hypno, 30)
+    
+    # Array with epoch onsets (in seconds) + all stages
+    all_stages = np.column_stack((np.asarray(onset),hypnogram))
+    
+    # Remove uncertain epochs
+    clean_stages = np.delete(all_stages,uncertain_epochs,axis=0)
+    
+    # Create annotations with scored stages as markers
+    annotations = mne.Annotations(onset=clean_stages[:,0], duration=30, description=clean_stages[:,1])  
+    
+    # Add to raw object
+    raw_EEG.set_annotations(annotations, emit_warning=True)  
+    
+    
+    return raw_EEG
+    
+    
+    
+# %% Function: compute_artifact_ptp
+
+"""
+    Compute peak-to-peak amplitudes used for artifact rejection, in one pass over the preprocessed EEG data (block by block): 
+    per 30 s epoch and channel (for PSD, as MNE epochs from 0 to 30 s, both included), and per 25 ms segment of the ROI average (for SSVEP).
+    Rejection thresholds can then be applied as boolean masks, without reading the data again.
+    
+    Input
+    ----------
+    raw_EEG : MNE raw object
+    Output of load_raw() for EEG channels, after artifact cleaning
+    
+    all_triggers : array or TriggerTrain
+    Output of import_triggers(); merged trigger set or from one session
+    
+    roi_ch : list
+    Names of the ROI channels, averaged for SSVEP segments
+    
+    block_epochs : int
+    Nr. of 30 s epochs read per block (default: 20)
+
+    Output
+    -------
+    artifact_ptp : dict
+    'epoch_ptp': peak-to-peak amplitude in Volts, shape (n_epochs, n_channels), epochs at multiples of 30 s from the start of the data; 
+    'ch_names': channel names; 'segment_ptp': peak-to-peak amplitude in microVolts of the ROI segment at each trigger (in trigger order; 
+    NaN for segments exceeding the data)
+
+"""
+
+def compute_artifact_ptp(raw_EEG, all_triggers, roi_ch, block_epochs=20):
+    
+    # Epoch length in data points
+    epoch_len = int(round(raw_EEG.info['sfreq'] * 30))
+    n_times = raw_EEG.n_times
+    n_epochs = -(-n_times // epoch_len)
+    
+    # Access trigger data points as array, sorted to find the triggers of each block
+    all_triggers = np.asarray(all_triggers)
+    trigger_order = np.argsort(all_triggers, kind='stable')
+    sorted_triggers = all_triggers[trigger_order]
+    
+    # ROI channels, in the same order as for SSVEP
+    roi_idx = [raw_EEG.ch_names.index(ch) for ch in roi_ch]
+    
+    # Initialize outputs
+    epoch_ptp = np.zeros([n_epochs, len(raw_EEG.ch_names)])
+    segment_ptp = np.full(len(all_triggers), np.nan)
+    
+    for first_epoch in range(0, n_epochs, block_epochs):
+        
+        # Block of data, plus the data points needed by the last epoch & segments (24 data points)
+        start = first_epoch * epoch_len
+        stop = min(start + block_epochs * epoch_len, n_times)
+        data = raw_EEG.get_data(start=start, stop=min(stop + 24, n_times))
+        
+        # Peak-to-peak per epoch & channel, from epoch start to 30 s later (included)
+        for epoch in range(first_epoch, min(first_epoch + block_epochs, n_epochs)):
+            first = epoch * epoch_len - start
+            epoch_ptp[epoch] = np.ptp(data[:, first:first+epoch_len+1], axis=1)
+        
+        # ROI average, in microVolts (as for SSVEP)
+        roi = (data[roi_idx] * 1e6).mean(axis=0)
+        
+        # Triggers of this block, whose segments are within the data
+        i0, i1 = np.searchsorted(sorted_triggers, [start, stop])
+        block_triggers = sorted_triggers[i0:i1] - start
+        within = block_triggers + 25 <= len(roi)
+        
+        # Peak-to-peak per segment
+        segment_view = np.lib.stride_tricks.sliding_window_view(roi, 25)
+        segment_ptp[trigger_order[i0:i1][within]] = np.ptp(segment_view[block_triggers[within]], axis=1)
+    
+    artifact_ptp = dict(epoch_ptp=epoch_ptp, ch_names=list(raw_EEG.ch_names), segment_ptp=segment_ptp)
+    
+    
+    return artifact_ptp
+
+
+
+# %% Function: get_rejected_epochs
+
+"""
+    Apply the PSD rejection criterion to precomputed peak-to-peak amplitudes (as reject=dict(eeg=0.001) in MNE epochs).
+    
+    Input
+    ----------
+    artifact_ptp : dict
+    Output of compute_artifact_ptp()
+    
+    info : MNE info
+    Info of the raw object the events belong to (for good EEG channels)
+    
+    events : array
+    MNE events of the epochs, starting at multiples of 30 s (as from select_annotations())
+    
+    first_samp : int
+    First data point of the raw object (events are relative to it)
+    
+    threshold : float
+    Max. peak-to-peak amplitude in Volts (default: 0.001, i.e. 1 mV)
+
+    Output
+    -------
+    rejected : array
+    True for each epoch exceeding the threshold in any good EEG channel
+
+"""
+
+def get_rejected_epochs(artifact_ptp, info, events, first_samp=0, threshold=0.001):
+    
+    # Good EEG channels
+    good_ch = [artifact_ptp['ch_names'].index(info['ch_names'][i]) for i in mne.pick_types(info, eeg=True, exclude='bads')]
+    
+    # Epoch index of each event
+    epochs = (events[:,0] - first_samp) // int(round(info['sfreq'] * 30))
+    
+    # Reject if above threshold in any good channel
+    rejected = (artifact_ptp['epoch_ptp'][epochs][:, good_ch] > threshold).any(axis=1)
+    
+    
+    return rejected
+    
+    
+    
+# %% Function: count_triggers
+
+"""
+    Count triggers within several windows at once, using binary search on the sorted triggers.
+    
+    Input
+    ----------
+    all_triggers : array or TriggerTrain
+    Output of import_triggers(); merged trigger set or from one session
+    
+    starts : array
+    First data point of each window
+    
+    ends : array
+    Last data point of each window (included)
+    
+    Output
+    -------
+    n_triggers : array
+    Nr. of triggers t with start <= t <= end, per window
+
+"""
+
+def count_triggers(all_triggers, starts, ends):
+    
+    # Compact trigger train: binary search on 1 Hz triggers
+    if isinstance(all_triggers, TriggerTrain):
+        return all_triggers.count_between(starts, ends)
+    
+    # Sort triggers, if needed (merged trigger sets may not be in order)
+    sorted_triggers = np.asarray(all_triggers)
+    if np.any(np.diff(sorted_triggers) < 0):
+        sorted_triggers = np.sort(sorted_triggers)
+    
+    # Nr. of triggers up to window end, minus nr. of triggers before window start
+    n_triggers = np.searchsorted(sorted_triggers, ends, side='right') - np.searchsorted(sorted_triggers, starts, side='left')
+    
+    
+    return n_triggers
+
+
+
+# %% Function: create_epochs
+
+"""
+    Construct and select epochs for PSD analysis based on chosen stage.
+    
+    Input
+    ----------
+    raw_EEG : MNE raw object
+	Output of select_annotations()
+    
+    all_triggers : array or TriggerTrain
+    Output of import_triggers(); merged trigger set or from one session
+    
+    event_id : int
+    Stage to include in epoch selection. 0=wake, 1=N1, 2=N2, 3=N3, 4=REM
+    
+    artifact_ptp : dict
+    Optional output of compute_artifact_ptp(); if given, bad epochs are rejected from it right away, 
+    instead of by MNE when the epochs are loaded (default: None)
+
+    Output
+    -------
+    epochs : MNE epochs object
+	Selection of 30 s trials for PSD analyses
+
+"""
+
+def create_epochs(raw_EEG, all_triggers, event_id, artifact_ptp=None):
+    
+    # Turn annotations of currently selected stage into events
+    events, _ = mne.events_from_annotations(raw_EEG, event_id = {str(event_id):event_id}, verbose=False)
+    
+    
+    ## Select epochs with enough triggers
+    
+    # Define minimal nr. of triggers required for a stimulation epoch (40 Hz, 25 sec)
+    min_n_triggers = 40 * 25
+    
+    # Get epoch starts (data points)
+    epoch_starts = events[:,0]
+    
+    # Define epoch ends after 30 sec, factoring in sample rate
+    epoch_ends = (epoch_starts + raw_EEG.info['sfreq'] * 30).astype(int)
+    
+    # Get nr. of triggers recorded between start & end of each epoch, all epochs at once
+    n_epoch_triggers = count_triggers(all_triggers, epoch_starts, epoch_ends)
+            
+    # Remove all epochs without a sufficient nr. of triggers from events
+    events_clean = events[n_epoch_triggers >= min_n_triggers]
+    
+    # Trial rejection criterion: 1 mV peak to peak; from precomputed amplitudes, if available
+    if artifact_ptp is not None:
+        events_clean = events_clean[~get_rejected_epochs(artifact_ptp, raw_EEG.info, events_clean, raw_EEG.first_samp)]
+        reject = None
+    else:
+        reject = dict(eeg = 0.001)
+    
+    
+    ## Create epochs object
+    
+    epochs = mne.Epochs(
+        raw_EEG,
+        events=events_clean,
+        tmin=0, # start trials at beginning of scored epochs
+        tmax=30, # end trials at end of scored epochs
+        reject=reject,  # trial rejection criterion: 1 mV peak to peak
+        baseline=None,
+        verbose=False
+    )
+    
+    
+    return epochs
+
+
+
+# %% Function: compute_PSD
+"""
+    Source code: https://mne.tools/stable/auto_tutorials/time-freq/50_ssvep.html
+
+    Compute PSD spectra and SNR values for current stage.
+    
+    Input
+    ----------
+    epochs : MNE epochs object or tuple
+    Output of create_epochs(); or tuple of precomputed spectra and frequencies, output of select_spectra()
+    
+    stage : int
+    Stage the epochs are assigned to (for plot title)
+    
+    target_freqs : list
+    Frequencies (Hz) at which PSD and SNR are reported if return_targets=True, e.g. harmonics & control frequencies (default: [40])
+    
+    return_targets : bool
+    Optionally also return PSD and SNR at all target frequencies (default: False)
+    
+    dtype : numpy dtype
+    Optional data type of the spectra, e.g. np.float32; noise sums and averages across epochs are computed in float64 
+    (default: None, data type of the input kept)
+
+    Output
+    -------
+    PSD_40Hz : int
+    Absolute PSD value at / near 40 Hz in dB
+    
+    SNR_40Hz : int
+    Absolute SNR value corresponding to PSD_40Hz
+    
+    PSD_spectrum : array
+    Average PSD spectrum across channels and epochs in current stage 
+    
+    SNR_spectrum : array
+    Average SNR spectrum of PSD values across channels and epochs in current stage
+    
+    target_metrics : dict
+    Only if return_targets=True; per target frequency: tuple of absolute PSD value in dB and SNR value, at the closest frequency bin
+
+"""
+
+def compute_PSD(epochs, stage, target_freqs=[40], return_targets=False, dtype=None):
+    
+    ## Compute PSD
+    
+    # Spectra precomputed for the whole night (bad epochs already rejected)
+    if isinstance(epochs, tuple):
+        
+        psds, freqs = epochs
+        
+    else:
+    
+        # Get sampling rate
+        sfreq = epochs.info["sfreq"]
+        
+        # Compute average PSD spectra for this stage's epochs
+        # Note: only at this point do bad epochs get rejected
+        spectrum = epochs.compute_psd(
+            "welch",
+            n_fft=int(sfreq * 30), # length of FFT in seconds
+            tmin=0,
+            tmax=30,
+            fmin=0, # min. frequency to include in spectra (Hz)
+            fmax=100, # max. frequency to include in spectra (Hz)
+            window='hamming',
+            verbose=False
+        )
+        
+        # Access spectra
+        # psds: ndarray with shape (n_epochs, n_channels, n_freqs)
+        # freqs: array with all frequency levels
+        psds, freqs = spectrum.get_data(return_freqs=True)
+    
+    # Convert data type, if requested
+    psds = np.asarray(psds, dtype=dtype)
+    
+    # Find index of frequency bin closest to stimulation frequency (here, 40 Hz)
+    idx_bin_40Hz = np.argmin(abs(freqs - 40))
+    
+    # Find index of lower boundary for target frequency range (here, 39.5 Hz)
+    idx_bin_lower = np.argmin(abs(freqs - 39.5))
+
+    # Half length of target frequency range (in nr. of frequency bins)
+    bin_len = idx_bin_40Hz - idx_bin_lower
+
+    
+    ## Compute SNR
+    
+    # Nr. of neighboring frequency bins used to compute noise level, on each side (here, 'noise' = [38-39.5 Hz] + [40.5-42 Hz])
+    noise_n_neighbor_freqs = bin_len*3
+
+    # Exclude immediately neighboring frequency bins in noise level calculation (here, 'signal' = [39.5-40.5 Hz])
+    noise_skip_neighbor_freqs = bin_len
+    
+    # Width of the averaging kernel: neighbors, skipped bins, center bin, skipped bins, neighbors
+    kernel_len = 2 * (noise_n_neighbor_freqs + noise_skip_neighbor_freqs) + 1
+
+    # Calculate the mean of the neighboring frequencies for all epochs and channels at once, 
+    # from differences of cumulative sums along the frequency axis (same as convolving with an averaging kernel)
+    cum_psds = np.concatenate((np.zeros(psds.shape[:-1] + (1,)), np.cumsum(psds, axis=-1, dtype=np.float64)), axis=-1)
+    n_valid = psds.shape[-1] - kernel_len + 1
+    lower_sum = cum_psds[..., noise_n_neighbor_freqs:noise_n_neighbor_freqs+n_valid] - cum_psds[..., 0:n_valid]
+    upper_sum = cum_psds[..., kernel_len:kernel_len+n_valid] - cum_psds[..., kernel_len-noise_n_neighbor_freqs:kernel_len-noise_n_neighbor_freqs+n_valid]
+    
+    # The mean is not defined on the edges so we will set it to nas there
+    edge_width = noise_n_neighbor_freqs + noise_skip_neighbor_freqs
+    mean_noise = np.full(psds.shape, np.nan, dtype=psds.dtype)
+    mean_noise[..., edge_width:edge_width+n_valid] = (lower_sum + upper_sum) / (2 * noise_n_neighbor_freqs)
+    
+    # Compute SNR spectra
+    # snrs: ndarray with shape (n_epochs, n_channels, n_freqs)
+    snrs = psds / mean_noise
+    
+    
+    ## Spectra
+    
+    freq_range = range(np.where(np.floor(freqs) == 0)[0][0], np.where(np.ceil(freqs) == 100)[0][0])
+    
+    # PSD spectrum
+    psds_plot = 10 * np.log10(psds) # in dB
+    psds_mean = psds_plot.mean(axis=(0, 1), dtype=np.float64)[freq_range] # across channels and epochs
+    psds_std = psds_plot.std(axis=(0, 1), dtype=np.float64)[freq_range] # add standard deviation
+    
+    # SNR spectrum
+    snr_mean = snrs.mean(axis=(0, 1), dtype=np.float64)[freq_range] # across channels and epochs
+    snr_std = snrs.std(axis=(0, 1), dtype=np.float64)[freq_range] # add standard deviation
+    
+    # Plot
+    # fig, axes = plt.subplots(2, 1, sharex='all', sharey='none', figsize=(8, 5))
+    
+    # axes[0].plot(freqs[freq_range], psds_mean, color='b')
+    # axes[0].fill_between(
+    #     freqs[freq_range], psds_mean - psds_std, psds_mean + psds_std,
+    #     color='b', alpha=.2)
+    # axes[0].set(title="PSD spectrum, stage "+str(stage), ylabel='Power Spectral Density [dB]')
+    
+    # axes[1].plot(freqs[freq_range], snr_mean, color='r')
+    # axes[1].fill_between(
+    #     freqs[freq_range], snr_mean - snr_std, snr_mean + snr_std,
+    #     color='r', alpha=.2)
+    # axes[1].set( title="SNR spectrum, stage "+str(stage), xlabel='Frequency [Hz]', ylabel='SNR', ylim=[-1, 50], xlim=[1, 100])
+    # fig.show()
+    
+    
+    ## Get metrics
+    
+    # Absolute PSD value at 40 Hz in dB
     PSD_40Hz = psds_mean[idx_bin_40Hz]
     
-    # Absolute SNR value corresponding to PSD_40Hz
-    SNR_40Hz = snr_mean[idx_bin_40Hz]
+    # Absolute SNR value corresponding to PSD_40Hz
+    SNR_40Hz = snr_mean[idx_bin_40Hz]
+    
+    # Average PSD spectrum across epochs and channels
+    PSD_spectrum = psds_mean
+    
+    # Average SNR spectrum across epochs and channels
+    SNR_spectrum = snr_mean
+    
+    
+    # Absolute PSD value in dB and SNR value at each target frequency, from the same spectra
+    target_metrics = dict()
+    for target_freq in target_freqs:
+        idx_bin = np.argmin(abs(freqs - target_freq))
+        target_metrics[target_freq] = (psds_mean[idx_bin], snr_mean[idx_bin])
+    
+    
+    ## Print & return results
+    
+    print('PSD SNR at 40 Hz: ' + str(round(SNR_40Hz,2)))
+    print('Absolute PSD value at 40 Hz (dB): ' + str(round(PSD_40Hz,2)))
+    
+    if return_targets:
+        return PSD_40Hz, SNR_40Hz, PSD_spectrum, SNR_spectrum, target_metrics
+    
+    return PSD_40Hz, SNR_40Hz, PSD_spectrum, SNR_spectrum
+    
+    
+    
+# %% Function: compute_epoch_spectra
+
+"""
+    Compute PSD spectra of all stimulated 30 s epochs of the recording at once, for all stages.
+    Replicates create_epochs() & the Welch PSD in compute_PSD() (1 segment of 30 s per epoch, Hamming window, 
+    constant detrend, density scaling), as batched FFTs instead of MNE epochs objects per stage.
+    Spectra keep the data type of raw_EEG (e.g. float32, see load_raw()).
+    
+    Input
+    ----------
+    raw_EEG : MNE raw object
+    Output of select_annotations()
+    
+    all_triggers : array or TriggerTrain
+    Output of import_triggers(); merged trigger set or from one session
+    
+    stages : list
+    Stages to include. 0=wake, 1=N1, 2=N2, 3=N3, 4=REM (default: [0,2,3,4])
+    
+    fmin, fmax : int
+    Frequency range of the spectra, in Hz (default: 0 - 100 Hz)
+    
+    workers : int
+    Nr. of parallel workers for the FFT; -1 for all CPU cores (default: -1)
+    
+    batch_size : int
+    Nr. of epochs transformed at once (default: 32)
+    
+    artifact_ptp : dict
+    Optional output of compute_artifact_ptp(), for rejection without recomputing peak-to-peak amplitudes (default: None)
+
+    Output
+    -------
+    epoch_spectra : dict
+    'psds': spectra, shape (n_epochs, n_channels, n_freqs), NaN for epochs exceeding the data; 'freqs': frequencies; 
+    'stages': stage of each epoch; 'rejected': True for epochs rejected (peak-to-peak > 1 mV, as in create_epochs()); 
+    'events': MNE events of the epochs
+
+"""
+
+def compute_epoch_spectra(raw_EEG, all_triggers, stages=[0,2,3,4], fmin=0, fmax=100, workers=-1, batch_size=32, artifact_ptp=None):
+    
+    ## Select epochs, as in create_epochs()
+    
+    # Get sampling rate
+    sfreq = raw_EEG.info['sfreq']
+    
+    # Turn annotations of all selected stages into events
+    events, _ = mne.events_from_annotations(raw_EEG, event_id = {str(stage):stage for stage in stages}, verbose=False)
+    
+    # Define minimal nr. of triggers required for a stimulation epoch (40 Hz, 25 sec)
+    min_n_triggers = 40 * 25
+    
+    # Get epoch starts & ends (data points), nr. of triggers in each epoch
+    epoch_starts = events[:,0]
+    epoch_ends = (epoch_starts + sfreq * 30).astype(int)
+    n_epoch_triggers = count_triggers(all_triggers, epoch_starts, epoch_ends)
+    
+    # Remove all epochs without a sufficient nr. of triggers from events
+    events = events[n_epoch_triggers >= min_n_triggers]
+    
+    
+    ## Spectrum parameters, as in compute_PSD()
+    
+    # Epoch length: 0 to 30 s, both included (as in MNE epochs); FFT length: 30 s
+    n_times = int(round(sfreq * 30)) + 1
+    n_fft = int(sfreq * 30)
+    
+    # Good EEG channels (rejection criterion and spectra)
+    picks = mne.pick_types(raw_EEG.info, eeg=True, exclude='bads')
+    
+    # Frequencies in range
+    freqs = np.arange(n_fft // 2 + 1) * (sfreq / n_fft)
+    freq_mask = (freqs >= fmin) & (freqs <= fmax)
+    
+    # Data type of the data & spectra
+    dtype = raw_EEG._data.dtype
+    
+    # Hamming window, density scaling; one-sided spectrum, so double all bins except 0 Hz and Nyquist frequency
+    window = scipy.signal.get_window('hamming', n_fft)
+    scale = 1.0 / (sfreq * (window**2).sum())
+    window = window.astype(dtype)
+    one_sided = np.full(len(freqs), 2.0, dtype=dtype)
+    one_sided[0] = 1.0
+    if n_fft % 2 == 0:
+        one_sided[-1] = 1.0
+    
+    
+    ## Compute spectra, in batches of epochs
+    
+    psds = np.full([len(events), len(picks), np.count_nonzero(freq_mask)], np.nan, dtype=dtype)
+    rejected = np.ones(len(events), dtype=bool)
+    
+    # Only epochs fully within the data (MNE drops the others)
+    first_samples = events[:,0] - raw_EEG.first_samp
+    in_data = np.flatnonzero((first_samples >= 0) & (first_samples + n_times <= raw_EEG.n_times))
+    
+    # Precomputed trial rejection
+    if artifact_ptp is not None:
+        rejected[in_data] = get_rejected_epochs(artifact_ptp, raw_EEG.info, events[in_data], raw_EEG.first_samp)
+    
+    for first in range(0, len(in_data), batch_size):
+        
+        batch = in_data[first:first+batch_size]
+        
+        # Epoch data, shape (n_batch, n_channels, n_times)
+        data = np.stack([raw_EEG.get_data(picks=picks, start=start, stop=start+n_times) for start in first_samples[batch]])
+        
+        # Trial rejection criterion: 1 mV peak to peak in any channel
+        if artifact_ptp is None:
+            rejected[batch] = (np.ptp(data, axis=2) > 0.001).any(axis=1)
+        
+        # Constant detrend & window the 30 s segment
+        data = data[..., :n_fft]
+        data = (data - data.mean(axis=-1, keepdims=True)) * window
+        
+        # Power spectral density
+        spectrum = scipy.fft.rfft(data, axis=-1, workers=workers)
+        power = (spectrum.real**2 + spectrum.imag**2) * scale * one_sided
+        psds[batch] = power[..., freq_mask]
+    
+    epoch_spectra = dict(psds=psds, freqs=freqs[freq_mask], stages=events[:,2], rejected=rejected, events=events)
+    
+    
+    return epoch_spectra
+
+
+
+# %% Function: select_spectra
+
+"""
+    Select spectra of good epochs of one stage from the output of compute_epoch_spectra().
+    
+    Input
+    ----------
+    epoch_spectra : dict
+    Output of compute_epoch_spectra()
+    
+    stage : int or tuple
+    Stage to select (0=wake, 1=N1, 2=N2, 3=N3, 4=REM), or tuple of stages to merge
+
+    Output
+    -------
+    psds : array
+    Spectra of the selected epochs, shape (n_epochs, n_channels, n_freqs)
+    
+    freqs : array
+    Frequencies of the spectra
+
+"""
+
+def select_spectra(epoch_spectra, stage):
+    
+    # Good epochs of this stage
+    selected = np.isin(epoch_spectra['stages'], np.atleast_1d(stage)) & ~epoch_spectra['rejected']
+    
+    
+    return epoch_spectra['psds'][selected], epoch_spectra['freqs']
+    
+    
+    
+# %% Function: permute_segments
+
+"""
+    Compute peak-to-trough amplitudes of random SSVEPs, each made from segments whose data points were randomly shuffled.
+    Permutations are computed in batches on copies of the segments; the input is never modified.
+    
+    Input
+    ----------
+    segments : array
+    Good segments of the current stage, shape (n_trials, 25)
+    
+    n_loops : int
+    Nr. of random SSVEPs (iterations)
+    
+    seed : int or numpy SeedSequence
+    Optional seed of the random number generator, for reproducible results
+    
+    batch_size : int
+    Nr. of iterations computed at once (default: all)
+    
+    Output
+    -------
+    random_amplitudes : array
+    Peak-to-trough amplitude of each random SSVEP
+
+"""
+
+def permute_segments(segments, n_loops, seed=None, batch_size=None):
+    
+    # Random number generator
+    rng = np.random.default_rng(seed)
+    
+    # Shuffle in float64 (no copy if converted by the caller, see compute_random_amplitudes())
+    segments = np.asarray(segments, dtype=np.float64)
+    
+    if batch_size is None:
+        batch_size = n_loops
+    
+    # Initialize array for shuffled peak-to-trough amplitudes
+    random_amplitudes = np.zeros([n_loops,])
+    
+    for first_loop in range(0, n_loops, batch_size):
+        
+        n_batch = min(batch_size, n_loops - first_loop)
+        
+        # Randomly shuffle the data points of each segment, independently per iteration; returns shuffled copies, shape (n_batch, n_trials, 25)
+        shuffled_segments = rng.permuted(np.broadcast_to(segments, (n_batch,) + segments.shape), axis=2)
+        
+        # Average to make random SSVEPs
+        random_SSVEPs = shuffled_segments.mean(axis=1)
+        
+        # Baseline correct
+        random_SSVEPs = random_SSVEPs - random_SSVEPs.mean(axis=1, keepdims=True)
+        
+        # Store peak-to-trough amplitude for these iterations
+        random_amplitudes[first_loop:first_loop+n_batch] = np.ptp(random_SSVEPs, axis=1)
+    
+    
+    return random_amplitudes
+
+
+
+# %% Function: permute_segments_shared
+
+"""
+    Same as permute_segments(), for worker processes: segments are read from shared memory instead of being pickled.
+    
+    Input
+    ----------
+    shm_name : str
+    Name of the shared memory block holding the segments
+    
+    shape : tuple
+    Shape of the segments array
+    
+    dtype : numpy dtype
+    Data type of the segments array
+    
+    n_loops, seed, batch_size : see permute_segments()
+    
+    Output
+    -------
+    random_amplitudes : array
+    Peak-to-trough amplitude of each random SSVEP
+
+"""
+
+def permute_segments_shared(shm_name, shape, dtype, n_loops, seed=None, batch_size=None):
+    
+    # Attach to shared memory, without copying
+    shm = shared_memory.SharedMemory(name=shm_name)
+    
+    try:
+        segments = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        random_amplitudes = permute_segments(segments, n_loops, seed, batch_size)
+        del segments
+    finally:
+        shm.close()
+    
+    
+    return random_amplitudes
+
+
+
+# %% Function: compute_random_amplitudes
+
+"""
+    Compute peak-to-trough amplitudes of random SSVEPs (for SNR), optionally in parallel and with an adaptive nr. of iterations.
+    Iterations are split into tasks of fixed size, each with its own random stream (SeedSequence.spawn), 
+    so that results for a given seed are the same regardless of the nr. of workers.
+    
+    Input
+    ----------
+    segments : array
+    Good segments of the current stage, shape (n_trials, 25)
+    
+    num_loops : int
+    Nr. of random SSVEPs (iterations), in fixed mode (tolerance None)
+    
+    seed : int or numpy SeedSequence
+    Optional seed of the random number generator, for reproducible results
+    
+    max_bytes : int
+    Max. memory used for a batch of shuffled segment matrices per task, in bytes (default: 256 MB)
+    
+    n_jobs : int
+    Nr. of parallel workers; -1 for all CPU cores (default: 1, no parallelization)
+    
+    max_total_bytes : int
+    Max. memory used by all concurrent tasks together, including the float64 copy of float32 segments, in bytes; limits the nr. of workers (default: 1 GB)
+    
+    backend : str
+    'thread' (default; shares memory directly) or 'process' (segments passed via shared memory).
+    Note: with 'process' on Windows, the calling script needs an if __name__ == '__main__' guard
+    
+    tolerance : float
+    Optional adaptive mode: batches of batch_loops iterations are run until the relative standard error 
+    of the mean random amplitude drops below this value (e.g. 0.01 for 1%), or max_loops is reached; num_loops is not used
+    
+    max_loops : int
+    Max. nr. of iterations in adaptive mode (default: 1000)
+    
+    batch_loops : int
+    Nr. of iterations per batch in adaptive mode, also the min. nr. of iterations (default: 20)
+    
+    Output
+    -------
+    random_amplitudes : array
+    Peak-to-trough amplitude of each random SSVEP; its length is the nr. of iterations used
+
+"""
+
+def compute_random_amplitudes(segments, num_loops, seed=None, max_bytes=2**28, n_jobs=1, backend='thread', tolerance=None, max_loops=1000, 
+                              max_total_bytes=2**30, batch_loops=20):
+    
+    # Nr. of iterations per batch: all at once in fixed mode, small batches in adaptive mode
+    if tolerance is not None:
+        num_loops = min(batch_loops, max_loops)
+    
+    # Shuffle in float64, also for float32 segments: same permutations, and rng.permuted() is faster on float64 data; 
+    # converted once here, shared by all tasks, and counted in the total memory budget
+    converted_bytes = segments.size * 8 if np.asarray(segments).dtype != np.float64 else 0
+    segments = np.asarray(segments, dtype=np.float64)
+    
+    # Nr. of iterations per task, within memory limit; independent of nr. of workers, 
+    # and of the data type (memory counted as float64), so that the random permutations for a given seed are always the same
+    loops_per_task = int(max(1, min(num_loops, max_bytes // max(1, segments.size * 8))))
+    
+    # Random streams; one child is spawned per task, in task order
+    seed_seq = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    
+    # Nr. of workers, at most one per task of a batch
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count()
+    n_jobs = min(n_jobs, -(-num_loops // loops_per_task))
     
-    # Average PSD spectrum across epochs and channels
-    PSD_spectrum = psds_mean
+    # Limit nr. of concurrent workers by total memory budget (minus the float64 copy), each running one task at a time (at least 1 worker)
+    n_jobs = max(1, min(n_jobs, (max_total_bytes - converted_bytes) // max(1, loops_per_task * segments.size * 8)))
     
-    # Average SNR spectrum across epochs and channels
-    SNR_spectrum = snr_mean
     
+    ## Set up workers
     
-    ## Print & return results
+    executor = None
+    shm = None
     
-    print('PSD SNR at 40 Hz: ' + str(round(SNR_40Hz,2)))
-    print('Absolute PSD value at 40 Hz (dB): ' + str(round(PSD_40Hz,2)))
+    if n_jobs > 1 and backend == 'thread':
+        
+        executor = ThreadPoolExecutor(max_workers=n_jobs)
+        
+    elif n_jobs > 1:
+        
+        # Put segments into shared memory once, workers read from there
+        segments = np.ascontiguousarray(segments)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, segments.nbytes))
+        np.ndarray(segments.shape, dtype=segments.dtype, buffer=shm.buf)[:] = segments
+        
+        executor = ProcessPoolExecutor(max_workers=n_jobs)
     
-    return PSD_40Hz, SNR_40Hz, PSD_spectrum, SNR_spectrum
     
+    ## Run batches of tasks
+    
+    def run_batch(n_batch):
+        
+        task_loops = [min(loops_per_task, n_batch - first_loop) for first_loop in range(0, n_batch, loops_per_task)]
+        task_seeds = seed_seq.spawn(len(task_loops))
+        n_tasks = len(task_loops)
+        
+        if executor is None:
+            results = [permute_segments(segments, n, task_seed) for n, task_seed in zip(task_loops, task_seeds)]
+        elif shm is None:
+            results = list(executor.map(permute_segments, [segments] * n_tasks, task_loops, task_seeds))
+        else:
+            results = list(executor.map(permute_segments_shared, [shm.name] * n_tasks, [segments.shape] * n_tasks, 
+                                        [segments.dtype] * n_tasks, task_loops, task_seeds))
+        
+        # Merge iterations of all tasks, in task order
+        return np.concatenate(results) if n_tasks > 0 else np.zeros(0)
+    
+    try:
+        
+        random_amplitudes = run_batch(num_loops)
+        
+        # Adaptive mode: add batches until the mean random amplitude is stable enough
+        if tolerance is not None:
+            
+            while len(random_amplitudes) < max_loops:
+                
+                # Relative standard error of the mean
+                rel_SE = random_amplitudes.std(ddof=1) / np.sqrt(len(random_amplitudes)) / random_amplitudes.mean() if len(random_amplitudes) > 1 else np.inf
+                
+                if rel_SE < tolerance:
+                    break
+                
+                random_amplitudes = np.concatenate([random_amplitudes, run_batch(min(num_loops, max_loops - len(random_amplitudes)))])
+        
+    finally:
+        
+        if executor is not None:
+            executor.shutdown()
+        if shm is not None:
+            shm.close()
+            shm.unlink()
     
     
+    return random_amplitudes
+
+
+
 # %% Function: compute_SSVEP
 
 """
     Source code: https://github.com/JamesDowsettNeuroscience/flicker_analysis_code
     
     Get SSVEP segments for current stage, compute SNR.
+    Single-stage version of compute_SSVEP_stages().
 
     Input
     ----------
     data : array
-    1 row, averaged ROI data
+    1 row, averaged ROI data; or channels x samples, for per-channel SSVEPs plus their ROI average
     
-    all_triggers : array
+    all_triggers : array or TriggerTrain
     Output of import_triggers(); merged trigger set or from one session
         
-    hypno_up : array
-    Output of score_sleep()
+    hypnogram : array
+    Output of score_sleep(), one stage per 30 s epoch
     
     condition : int
     Number of current condition: 0=wake, 1=N1, 2=N2, 3=N3, 4=REM
         
     SNR : bool
     Optional calculation of SNR
+    
+    num_loops : int
+    Nr. of iterations (random permutations) for SNR calculation (default: 100)
+    
+    seed : int or numpy SeedSequence
+    Optional seed of the random number generator used for SNR calculation, for reproducible results
+    
+    n_jobs : int
+    Nr. of parallel workers for SNR calculation; -1 for all CPU cores (default: 1)
+    
+    backend : str
+    Parallelization over 'thread' (default) or 'process' workers, see compute_random_amplitudes()
+    
+    SNR_tolerance : float
+    Optional adaptive nr. of iterations: permutations are run in batches of SNR_batch until the relative standard error 
+    of the average noise drops below this value, or max_loops is reached (default: None, fixed num_loops)
+    
+    max_loops : int
+    Max. nr. of iterations in adaptive mode (default: 1000)
+    
+    SNR_batch : int
+    Nr. of iterations per batch in adaptive mode, also the min. nr. of iterations (default: 20)
+    
+    sfreq : int
+    Sampling frequency of the data (default: 1000)
+    
+    uncertain_epochs : list
+    Optional epoch indices whose triggers are excluded (default: None, all epochs included)
+    
+    segment_ptp : array
+    Optional precomputed peak-to-peak amplitudes of the ROI segments, see compute_SSVEP_stages() (default: None)
+    
+    dtype : numpy dtype
+    Optional data type of the data & segments, e.g. np.float32; sums over segments are computed in float64 
+    (default: None, data type of the input kept)
 
     Output
     ----------
@@ -843,66 +2646,20 @@ def compute_PSD(epochs, stage):
     SSVEP : array
     Final averaged SSVEP curve
     
+    For channels x samples data, each output has one entry (row) per channel, followed by the ROI average as last entry.
+    
 """
 
-def compute_SSVEP(data, all_triggers, hypno_up, condition, computeSNR=True):
+def compute_SSVEP(data, all_triggers, hypnogram, condition, computeSNR=True, num_loops=100, seed=None, n_jobs=1, backend='thread', SNR_tolerance=None, max_loops=1000, SNR_batch=20, 
+                  sfreq=1000, uncertain_epochs=None, segment_ptp=None, dtype=None):
         
-    ## Compute "true" SSVEP
+    ## Compute SSVEP & SNR for the current stage
     
-    # Initialize array for trigger subset
-    triggers = []
+    true_amplitude, SNR, n_trials, SSVEP, stand_errors, n_permutations = compute_SSVEP_stages(data, all_triggers, hypnogram, stages=[condition], computeSNR=computeSNR, 
+                                                                                              num_loops=num_loops, seed=seed, n_jobs=n_jobs, backend=backend, 
+                                                                                              SNR_tolerance=SNR_tolerance, max_loops=max_loops, SNR_batch=SNR_batch, sfreq=sfreq, 
+                                                                                              uncertain_epochs=uncertain_epochs, segment_ptp=segment_ptp, dtype=dtype)[condition]
     
-    # Select subset of triggers for current stage
-    for i in range(len(all_triggers)):
-        
-        trig = all_triggers[i] # current trigger
-        
-        if hypno_up[trig] == condition: # if current trigger matches current stage
-            
-            triggers.append(trig) # add trigger to list   
-    
-    # Initialize empty matrix to put segments into        
-    segment_matrix = np.zeros([len(triggers),25])         
-                    
-    # Counters
-    trig_count = 0
-    
-    # Loop over trigger subset
-    for trigger in triggers:
- 
-        segment = data[trigger:trigger+25] # current segment
- 
-        # Include only segments with a peak-to-trough amplitude below 100 uV
-        if np.ptp(segment) < 100: 
-        
-            segment_matrix[trig_count,:] = segment # put into matrix                        
-            
-            trig_count += 1 # update counter
-            
-    # Get nr. of segments included
-    n_trials = trig_count
-    
-    # Display nr. of segments included
-    print('\nStage', condition, '\n')
-    print(trig_count, 'good segments of', len(triggers))
-                
-    # Average to make the SSVEP
-    SSVEP = segment_matrix[0:trig_count,:].mean(axis=0) 
-    
-    # Baseline correct 
-    SSVEP = SSVEP - SSVEP.mean() 
-    
-    # Get peak-to-trough amplitude
-    true_amplitude = np.ptp(SSVEP) 
-    
-    # Initialize array for standard error values
-    stand_errors = np.zeros(25)
-    
-    # Get standard error for each point in SSVEP
-    for pt in range(len(segment_matrix[0])):
-        
-        stand_errors[pt] = scipy.stats.sem(segment_matrix[:,pt])
-       
     
     ## Plot
     
@@ -921,68 +2678,562 @@ def compute_SSVEP(data, all_triggers, hypno_up, condition, computeSNR=True):
     
     # # Plot shaded error region
     # plt.fill_between(range(0,25), SSVEP-stand_errors, SSVEP+stand_errors, alpha = 0.3) 
+
+
+    return true_amplitude, SNR, n_trials, SSVEP
+
+
+
+# %% Function: compute_SSVEP_stages
+
+"""
+    Get SSVEP segments for several stages in one pass, compute SNR.
+    Every trigger is labelled with its stage once; segments are extracted once, in chunks, and accumulated 
+    into per-stage sums and sums of squares. Merged stages (e.g. (2,3) for NREM sleep) are built from the sums 
+    of their components, without another pass over the data.
+    For channels x samples data, all channels are computed as one batched tensor operation, in chunks of channels; 
+    the ROI average is derived from the channels and handled as in the 1-row case (segments rejected on the ROI signal).
+
+    Input
+    ----------
+    data : array
+    1 row, averaged ROI data; or channels x samples, for per-channel SSVEPs plus their ROI average
+    
+    all_triggers : array or TriggerTrain
+    Output of import_triggers(); merged trigger set or from one session
+        
+    hypnogram : array
+    Output of score_sleep(), one stage per 30 s epoch
+    
+    stages : list
+    Stages to compute: int (0=wake, 1=N1, 2=N2, 3=N3, 4=REM) or tuple of int for merged stages (default: [0,2,3,4])
+        
+    computeSNR, num_loops, seed, n_jobs, backend, SNR_tolerance, max_loops, SNR_batch, sfreq, uncertain_epochs : see compute_SSVEP()
+    
+    chunk_size : int
+    Nr. of triggers whose segments are extracted at once (default: 2**16)
+    
+    segment_ptp : array
+    Optional precomputed peak-to-peak amplitude of the ROI segment at each trigger ('segment_ptp' of compute_artifact_ptp(), 
+    for the same triggers), used for rejection instead of the segments' own amplitude (default: None)
+    
+    threshold : float
+    Max. peak-to-peak amplitude of a segment in microVolts (default: 100)
+    
+    channel_chunk : int
+    Nr. of channels whose segments are extracted at once (default: 8)
+    
+    channel_SNR : bool
+    For channels x samples data: compute the SNR for every channel, one permutation run each; if False, for the ROI average only, 
+    the channels' SNR is NaN (default: False)
+    
+    dtype : see compute_SSVEP()
+
+    Output
+    ----------
+    SSVEP_stages : dict
+    Per stage (key as given in stages): tuple of true_amplitude, SNR, n_trials, SSVEP as in compute_SSVEP(), 
+    followed by stand_errors (standard error for each point in SSVEP) and n_permutations (nr. of permutations used for the SNR; 0 if not computed). 
+    For channels x samples data, one entry (row) per channel, followed by the ROI average as last entry.
+    
+"""
+
+def compute_SSVEP_stages(data, all_triggers, hypnogram, stages=[0,2,3,4], computeSNR=True, num_loops=100, seed=None, n_jobs=1, 
+                         backend='thread', SNR_tolerance=None, max_loops=1000, SNR_batch=20, sfreq=1000, uncertain_epochs=None, chunk_size=2**16, 
+                         channel_chunk=8, segment_ptp=None, threshold=100, channel_SNR=False, dtype=None):
+    
+    ## Label triggers
+    
+    # Access trigger data points as array
+    all_triggers = np.asarray(all_triggers)
     
+    # Single stages needed for all requested (merged) stages
+    stage_sets = {stage: np.atleast_1d(stage) for stage in stages}
+    components = np.unique(np.concatenate(list(stage_sets.values()))) if len(stages) > 0 else np.zeros(0, dtype=int)
     
-    ## Compute SNR (optional)
-    # Note: compute by randomly shuffling the data points of each segment and then making the SSVEP, compare to true SSVEP - looped               
-    # Skip to quickly check SSVEP; this takes a few minutes, depending on num_loops
+    # Stage of each trigger, from the hypnogram at epoch resolution
+    labels = get_trigger_stages(all_triggers, hypnogram, sfreq, uncertain_epochs)
     
-    if computeSNR: 
+    # Stage membership of each trigger, shape (n_stages, n_triggers)
+    in_stage = labels[None,:] == components[:,None]
+    n_all = in_stage.sum(axis=1)
+    
+    
+    ## Blocks of rows (channels) to process; the ROI average is the last row
+    
+    data = np.asarray(data, dtype=dtype)
+    single_row = data.ndim == 1
+    
+    if single_row:
+        row_blocks = [data[None,:]]
+    else:
+        row_blocks = [data[first:first+channel_chunk] for first in range(0, len(data), channel_chunk)] + [data.mean(axis=0)[None,:]]
+    
+    n_rows = sum(len(block) for block in row_blocks)
+    
+    
+    ## Accumulate segments, one pass over the triggers per block of rows
+    
+    # Per row & single stage: sum and sum of squares of good segments, nr. of good segments
+    sums = np.zeros([n_rows, len(components), 25])
+    sums_sq = np.zeros([n_rows, len(components), 25])
+    n_good = np.zeros([n_rows, len(components)], dtype=int)
+    
+    # Good segment mask per row & trigger, for SNR
+    good_segments = np.zeros([n_rows, len(all_triggers)], dtype=bool)
+    
+    first_row = 0
+    
+    for block in row_blocks:
+        
+        rows = slice(first_row, first_row + len(block))
+        
+        # Zero-copy sliding window view of the data; [row, i] is the segment starting at sample i
+        segment_view = np.lib.stride_tricks.sliding_window_view(block, 25, axis=1)
+    
+        for first in range(0, len(all_triggers), chunk_size):
+            
+            chunk = slice(first, first + chunk_size)
+            
+            # Segments of this chunk, shape (n_block, n_chunk, 25)
+            segments = segment_view[:, all_triggers[chunk]]
+            
+            # Include only segments with a peak-to-trough amplitude below 100 uV; for the ROI (last row), from precomputed amplitudes if available
+            if segment_ptp is not None and rows.stop == n_rows:
+                good_segments[rows.start:n_rows-1, chunk] = np.ptp(segments[:-1], axis=2) < threshold
+                good_segments[-1, chunk] = segment_ptp[chunk] < threshold
+            else:
+                good_segments[rows, chunk] = np.ptp(segments, axis=2) < threshold
+            
+            # Good segments per stage, shape (n_block, n_stages, n_chunk)
+            in_stage_good = (in_stage[None,:,chunk] & good_segments[rows, None, chunk]).astype(float)
+            
+            # Accumulate; in float64, also for float32 segments (converted once per chunk, faster than mixed-type products)
+            segments = segments.astype(np.float64, copy=False)
+            sums[rows] += in_stage_good @ segments
+            sums_sq[rows] += in_stage_good @ segments**2
+            n_good[rows] += in_stage_good.sum(axis=2).astype(int)
         
-        print('Computing SNR...')
+        first_row += len(block)
+    
+    
+    ## Compute SSVEP per (merged) stage
+    
+    SSVEP_stages = dict()
+    
+    # Random streams for the SNR; one child is spawned per stage & row, so that their permutations are independent
+    seed_seq = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    
+    for stage, stage_set in stage_sets.items():
         
-        # Define nr. of iterations for SNR calculation
-        num_loops = 100
+        # Combine components
+        idx = np.searchsorted(components, stage_set)
+        stage_sum = sums[:,idx].sum(axis=1)
+        stage_sum_sq = sums_sq[:,idx].sum(axis=1)
+        trig_count = n_good[:,idx].sum(axis=1)
+        n_triggers = int(n_all[idx].sum())
         
-        # Initialize array for shuffled peak-to-trough amplitudes
-        random_amplitudes = np.zeros([num_loops,])
+        # Display nr. of segments included (ROI)
+        print('\nStage', stage, '\n')
+        print(trig_count[-1], 'good segments of', n_triggers)
         
-        # Loop over defined nr. of iterations
-        for loop in range(0,num_loops):
+        with np.errstate(invalid='ignore', divide='ignore'):
             
-            # Initialize array for shuffled segments
-            shuffled_segment_matrix =  np.zeros([len(triggers), 25])  
+            # Average to make the SSVEP
+            SSVEP = stage_sum / trig_count[:,None]
             
-            # Loop over all triggers for this stage 
-            trig_count = 0
+            # Baseline correct 
+            SSVEP = SSVEP - SSVEP.mean(axis=1, keepdims=True) 
             
-            for trigger in triggers:
-                
-                segment =  data[trigger:trigger+25] # select current segment
+            # Get peak-to-trough amplitude
+            true_amplitude = np.ptp(SSVEP, axis=1) 
+            
+            # Get standard error for each point in SSVEP; over all segments, rejected ones counting as zeros (as in the original matrix)
+            variance = (stage_sum_sq - stage_sum**2 / n_triggers) / (n_triggers - 1)
+            stand_errors = np.sqrt(np.maximum(variance, 0) / n_triggers)
+        
+        
+        ## Compute SNR (optional)
+        # Note: compute by randomly shuffling the data points of each segment and then making the SSVEP, compare to true SSVEP
+        
+        SNR = np.full(n_rows, np.nan)
+        n_permutations = np.zeros(n_rows, dtype=int)
+        
+        if computeSNR: 
+            
+            print('Computing SNR...')
+            
+            in_stage_set = np.isin(labels, stage_set)
+            row_seeds = seed_seq.spawn(n_rows)
+            
+            row = 0
+            for block in row_blocks:
+                segment_view = np.lib.stride_tricks.sliding_window_view(block, 25, axis=1)
                 
-                if np.ptp(segment) < 100: # as in "true" SSVEP, include only good segments
-              
-                    random.shuffle(segment) # randomly shuffle the data points
+                for block_row in range(len(block)):
                     
-                    shuffled_segment_matrix[trig_count,:] = segment # add segment to matrix
+                    # Skip channels unless their SNR is requested; the ROI average (last row) is always computed
+                    if not channel_SNR and row < n_rows - 1:
+                        row += 1
+                        continue
                     
-                    trig_count += 1 # update counter
-            
-            # Average to make random SSVEP
-            random_SSVEP = shuffled_segment_matrix[0:trig_count,:].mean(axis=0) 
+                    # Good segments of this stage & row, in trigger order
+                    segments = segment_view[block_row, all_triggers[in_stage_set & good_segments[row]]]
+                    
+                    # Get peak-to-trough amplitudes of random SSVEPs
+                    random_amplitudes = compute_random_amplitudes(segments, num_loops, row_seeds[row], n_jobs=n_jobs, backend=backend, 
+                                                                  tolerance=SNR_tolerance, max_loops=max_loops, batch_loops=SNR_batch)
+                    
+                    # Compute SNR from mean of random peak-to-trough amplitude
+                    SNR[row] = true_amplitude[row]/random_amplitudes.mean()
+                    
+                    # Store nr. of permutations used, varies per row if SNR_tolerance is set
+                    n_permutations[row] = len(random_amplitudes)
+                    
+                    row += 1
             
-            # Baseline correct
-            random_SSVEP = random_SSVEP - random_SSVEP.mean() 
+            print('Permutations used for SNR:', n_permutations[-1])
+            print('SSVEP SNR:', round(SNR[-1],2))
             
-            # Store peak-to-trough amplitude for this iteration
-            random_amplitudes[loop] = np.ptp(random_SSVEP)
-               
-        # Get mean of random peak-to-trough amplitude   
-        average_noise = random_amplitudes.mean()         
+        print('Peak-to-trough amplitude ('+ u"\u03bcV):", round(true_amplitude[-1], 2))
+        
+        # Scalars & 1D arrays for 1-row data
+        if single_row:
+            SSVEP_stages[stage] = (true_amplitude[0], SNR[0] if computeSNR else float('NaN'), int(trig_count[0]), SSVEP[0], stand_errors[0], 
+                                   int(n_permutations[0]))
+        else:
+            SSVEP_stages[stage] = (true_amplitude, SNR, trig_count, SSVEP, stand_errors, n_permutations)
+
+
+    return SSVEP_stages
+
+
+
+# %% Function: compute_SSVEP_trajectory
+
+"""
+    Get SSVEP amplitude & nr. of trials per time window across the whole recording, to follow entrainment over the night.
+    Segments are extracted and rejected as in compute_SSVEP_stages(), summed per 30 s epoch and accumulated over the night 
+    (cumulative sums in trigger order), so that windows of any nr. of epochs are obtained by differences, without re-segmenting.
+
+    Input
+    ----------
+    data : array
+    1 row, averaged ROI data; channels x samples data is averaged over channels first
+    
+    all_triggers : array or TriggerTrain
+    Output of import_triggers(); merged trigger set or from one session
+        
+    hypnogram : array
+    Output of score_sleep(), one stage per 30 s epoch
+    
+    confidence : array
+    Optional output of score_sleep(return_confidence=True), YASA confidence per epoch (default: None)
+    
+    window_len : int
+    Window length in epochs; 1 for 30 s windows, 2*N for N-minute windows (default: 1)
+    
+    sfreq : int
+    Sampling frequency of the data (default: 1000)
+    
+    chunk_size : int
+    Nr. of triggers whose segments are extracted at once (default: 2**16)
+
+    Output
+    ----------
+    trajectory : pandas DataFrame
+    One row per window: first epoch, start time (min), stage (most frequent), mean confidence, time since onset of the 
+    current stage (min, at window start), nr. of triggers, nr. of trials (good segments) and SSVEP peak-to-trough amplitude
+    
+"""
+
+def compute_SSVEP_trajectory(data, all_triggers, hypnogram, confidence=None, window_len=1, sfreq=1000, chunk_size=2**16):
+    
+    ## Sum good segments per epoch
+    
+    # Access trigger data points & hypnogram as arrays
+    all_triggers = np.asarray(all_triggers)
+    hypnogram = np.asarray(hypnogram)
+    n_epochs = len(hypnogram)
+    
+    # ROI average, if channels given
+    data = np.asarray(data)
+    if data.ndim > 1:
+        data = data.mean(axis=0)
+    
+    # Epoch of each trigger; triggers after the last epoch belong to it (as in get_trigger_stages())
+    epochs = np.minimum(all_triggers // int(round(sfreq * 30)), n_epochs - 1)
+    
+    # Per epoch: sum of good segments, nr. of good segments, nr. of all segments
+    epoch_sums = np.zeros([n_epochs, 25])
+    epoch_good = np.zeros(n_epochs, dtype=int)
+    epoch_all = np.bincount(epochs, minlength=n_epochs)
+    
+    # Zero-copy sliding window view of the data; row i is the segment starting at sample i
+    segment_view = np.lib.stride_tricks.sliding_window_view(data, 25)
     
-        # Compute SNR
-        SNR = true_amplitude/average_noise
+    for first in range(0, len(all_triggers), chunk_size):
         
-        print('SSVEP SNR:', round(SNR,2))
+        chunk = slice(first, first + chunk_size)
         
-    else: # if SNR not computed, assign NaN
+        # Segments of this chunk, shape (n_chunk, 25)
+        segments = segment_view[all_triggers[chunk]]
         
-        SNR = float('NaN')
-            
-    print('Peak-to-trough amplitude ('+ u"\u03bcV):", round(true_amplitude, 2))          
+        # Include only segments with a peak-to-trough amplitude below 100 uV
+        good_segments = np.ptp(segments, axis=1) < 100
+        
+        # Accumulate per epoch
+        np.add.at(epoch_sums, epochs[chunk][good_segments], segments[good_segments])
+        epoch_good += np.bincount(epochs[chunk][good_segments], minlength=n_epochs)
+    
+    
+    ## Cumulative sums over the night, with a leading zero
+    
+    cum_sums = np.concatenate((np.zeros([1,25]), np.cumsum(epoch_sums, axis=0)))
+    cum_good = np.concatenate(([0], np.cumsum(epoch_good)))
+    cum_all = np.concatenate(([0], np.cumsum(epoch_all)))
+    
+    # Stages (one-hot, 0 to 4) and confidence
+    cum_stages = np.concatenate((np.zeros([1,5], dtype=int), np.cumsum(hypnogram[:,None] == np.arange(5)[None,:], axis=0)))
+    cum_confidence = np.concatenate(([0], np.cumsum(confidence))) if confidence is not None else None
+    
+    # Time since onset of the current stage, per epoch
+    stage_change = np.concatenate(([True], hypnogram[1:] != hypnogram[:-1])) if n_epochs > 0 else np.zeros(0, dtype=bool)
+    stage_onset = np.maximum.accumulate(np.where(stage_change, np.arange(n_epochs), 0)) if n_epochs > 0 else np.zeros(0, dtype=int)
+    
+    
+    ## Windows
+    
+    starts = np.arange(0, n_epochs, window_len)
+    ends = np.minimum(starts + window_len, n_epochs)
+    
+    # Sums per window from differences of cumulative sums
+    n_trials = cum_good[ends] - cum_good[starts]
+    n_triggers = cum_all[ends] - cum_all[starts]
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+    
+        # Average to make the SSVEP
+        SSVEP = (cum_sums[ends] - cum_sums[starts]) / n_trials[:,None]
+        
+        # Baseline correct
+        SSVEP = SSVEP - SSVEP.mean(axis=1, keepdims=True)
+        
+        # Get peak-to-trough amplitude
+        amplitude = np.ptp(SSVEP, axis=1)
+        
+        # Mean confidence
+        window_confidence = (cum_confidence[ends] - cum_confidence[starts]) / (ends - starts) if confidence is not None else np.full(len(starts), np.nan)
+    
+    # Most frequent stage
+    window_stage = np.argmax(cum_stages[ends] - cum_stages[starts], axis=1)
+    
+    # Output table
+    trajectory = pd.DataFrame({'epoch': starts, 
+                               'time_min': starts * 0.5, 
+                               'stage': window_stage, 
+                               'confidence': window_confidence, 
+                               'time_in_stage_min': (starts - stage_onset[starts]) * 0.5, 
+                               'n_triggers': n_triggers, 
+                               'n_trials': n_trials, 
+                               'SSVEP_PTA': amplitude})
+    
+    
+    return trajectory
 
 
-    return true_amplitude, SNR, n_trials, SSVEP
 
+# %% Function: compute_envelope_40Hz
+
+"""
+    Compute the 40 Hz amplitude envelope of the ROI signal across the whole recording, as a continuous measure of entrainment.
+    The ROI signal is filtered with a complex (analytic) band-pass FIR filter around 40 Hz, whose output magnitude is the envelope.
+    Filtering is done block-wise with overlap-save FFT convolution, so memory is bounded by the block size; 
+    the envelope is averaged into bins on the fly (downsampled) and per 30 s epoch of the hypnogram.
+    
+    Input
+    ----------
+    source : MNE raw object or str
+    Output of load_raw() for EEG channels (preloaded, re-referenced); or path to the EEG data file in EDF format, 
+    read block by block and re-referenced to the mastoids as in load_raw() (bad channels not re-referenced)
+    
+    roi_ch : list
+    Names of the ROI channels (renamed as in load_raw())
+    
+    bad_ch : list
+    Names of bad channels, only used for the mastoid reference when reading from EDF; bad ROI channels are averaged without re-referencing, 
+    as in load_raw() (default: [])
+    
+    hypnogram : array
+    Optional output of score_sleep(), one stage per 30 s epoch (default: None)
+    
+    freq : int
+    Center frequency in Hz (default: 40)
+    
+    bandwidth : int
+    Width of the pass band in Hz (default: 4, i.e. 38 - 42 Hz)
+    
+    numtaps : int
+    Optional FIR filter length (odd); default: ~3.3 s for a 1 Hz transition band at 4 Hz bandwidth
+    
+    out_sfreq : int
+    Sampling frequency of the downsampled envelope in Hz (default: 1)
+    
+    block_len : int
+    FFT length for overlap-save filtering; also nr. of data points read per block from a raw object (default: 2**16)
+    
+    block_records : int
+    Nr. of EDF data records read per block, see iter_edf_blocks() (default: 600)
+
+    Output
+    -------
+    envelope : array
+    40 Hz envelope of the ROI signal in microVolts, averaged per 1/out_sfreq seconds
+    
+    envelope_epochs : pandas DataFrame
+    Only if a hypnogram is given (otherwise None); per epoch: start time (min), stage, mean 40 Hz envelope
+
+"""
+
+def compute_envelope_40Hz(source, roi_ch, bad_ch=[], hypnogram=None, freq=40, bandwidth=4, numtaps=None, out_sfreq=1, block_len=2**16, block_records=600):
+    
+    ## Source of ROI data, in blocks (microVolts)
+    
+    if isinstance(source, str):
+        
+        # Mastoid reference, unless one of the 2 channels is marked as bad (as in load_raw())
+        if 'A1' in bad_ch:
+            ref_ch = ['A2']
+        elif 'A2' in bad_ch:
+            ref_ch = ['A1']
+        else:
+            ref_ch = ['A1','A2']
+        
+        # EDF channel names
+        edf_names = {new:old for old, new in channel_renames.items()}
+        read_ch = [edf_names.get(ch, ch) for ch in roi_ch + ref_ch]
+        
+        # Bad channels are not re-referenced, as in raw.set_eeg_reference()
+        ref_to = np.array([ch not in bad_ch for ch in roi_ch])
+        
+        # Sampling rate
+        header = read_edf_header(source)
+        sfreq = header['n_samples'][header['labels'].index(read_ch[0])] / header['record_duration']
+        
+        # ROI average of re-referenced channels = average of channels - reference, weighted by the fraction of good channels
+        def roi_blocks():
+            for _, data in iter_edf_blocks(source, read_ch, block_records):
+                yield (data[:len(roi_ch)].mean(axis=0) - ref_to.mean() * data[len(roi_ch):].mean(axis=0)) * 1e6
+        
+    else:
+        
+        sfreq = source.info['sfreq']
+        
+        # ROI average, one block at a time
+        def roi_blocks():
+            for start in range(0, source.n_times, block_len):
+                yield source.get_data(picks=roi_ch, start=start, stop=min(start + block_len, source.n_times)).mean(axis=0) * 1e6
+    
+    
+    ## Complex band-pass filter
+    
+    # Low-pass prototype with half the bandwidth as cutoff (Hamming window), odd length
+    if numtaps is None:
+        numtaps = int(3.3 * sfreq / (bandwidth / 4))
+    numtaps += 1 - numtaps % 2
+    lowpass = scipy.signal.firwin(numtaps, bandwidth / 2, fs=sfreq)
+    
+    # Shift to the center frequency; positive frequencies only, so the output is the analytic signal (at half amplitude)
+    delay = (numtaps - 1) // 2
+    band_filter = lowpass * np.exp(2j * np.pi * freq * (np.arange(numtaps) - delay) / sfreq)
+    
+    # Filter in frequency domain; nr. of new data points per FFT block
+    n_fft = max(block_len, 2 ** int(np.ceil(np.log2(2 * numtaps))))
+    filter_fft = scipy.fft.fft(band_filter, n_fft)
+    step = n_fft - numtaps + 1
+    
+    
+    ## Overlap-save filtering & downsampling, block by block
+    
+    # Nr. of data points averaged per envelope value
+    bin_len = int(round(sfreq / out_sfreq))
+    
+    # Buffers: previous input (zeros before the recording), input not yet filtered, envelope not yet averaged
+    history = np.zeros(numtaps - 1)
+    pending = np.zeros(0)
+    unbinned = np.zeros(0)
+    
+    # Filter output is delayed by half the filter length; skip the first outputs to align it with the data
+    n_skip = delay
+    n_total = 0
+    envelope = []
+    
+    def filter_blocks(pending, history, final=False):
+        
+        # Filter as many full steps as available (all remaining data at the end, zero-padded)
+        outputs = []
+        while len(pending) >= step or (final and len(pending) > 0):
+            new = pending[:step]
+            segment = np.concatenate((history, new, np.zeros(step - len(new))))
+            filtered = scipy.fft.ifft(scipy.fft.fft(segment) * filter_fft)[numtaps-1:numtaps-1+len(new)]
+            outputs.append(2 * np.abs(filtered))
+            history = segment[step:step+numtaps-1] if len(new) == step else np.concatenate((history, new))[-(numtaps-1):]
+            pending = pending[step:]
+        
+        return np.concatenate(outputs) if outputs else np.zeros(0), pending, history
+    
+    def bin_envelope(unbinned, new, final=False):
+        
+        # Average full bins; the incomplete last bin only at the end
+        unbinned = np.concatenate((unbinned, new))
+        n_bins = len(unbinned) // bin_len
+        binned = list(unbinned[:n_bins*bin_len].reshape(n_bins, bin_len).mean(axis=1))
+        unbinned = unbinned[n_bins*bin_len:]
+        if final and len(unbinned) > 0:
+            binned.append(unbinned.mean())
+            unbinned = np.zeros(0)
+        
+        return binned, unbinned
+    
+    for block in roi_blocks():
+        
+        n_total += len(block)
+        pending = np.concatenate((pending, block))
+        
+        # Filter, then drop outputs before the first data point (filter delay)
+        filtered, pending, history = filter_blocks(pending, history)
+        dropped = min(n_skip, len(filtered))
+        n_skip -= dropped
+        
+        binned, unbinned = bin_envelope(unbinned, filtered[dropped:])
+        envelope += binned
+    
+    # Flush: zeros after the recording to get the outputs of the last data points
+    pending = np.concatenate((pending, np.zeros(delay)))
+    filtered, pending, history = filter_blocks(pending, history, final=True)
+    filtered = filtered[min(n_skip, len(filtered)):]
+    
+    # Keep exactly one envelope value per data point
+    n_binned = len(envelope) * bin_len + len(unbinned)
+    binned, unbinned = bin_envelope(unbinned, filtered[:max(0, n_total - n_binned)], final=True)
+    envelope = np.asarray(envelope + binned)
+    
+    
+    ## Align with hypnogram epochs
+    
+    envelope_epochs = None
+    
+    if hypnogram is not None:
+        
+        # Nr. of envelope values per 30 s epoch; epochs not fully covered by data are averaged over the available part
+        epoch_bins = int(round(30 * out_sfreq))
+        epoch_starts = np.arange(len(hypnogram)) * epoch_bins
+        epoch_means = [envelope[start:start+epoch_bins].mean() if start < len(envelope) else np.nan for start in epoch_starts]
+        
+        envelope_epochs = pd.DataFrame({'epoch': np.arange(len(hypnogram)), 
+                                        'time_min': np.arange(len(hypnogram)) * 0.5, 
+                                        'stage': hypnogram, 
+                                        'envelope_40Hz': epoch_means})
+    
     
-    
\ No newline at end of file
+    return envelope, envelope_epochs
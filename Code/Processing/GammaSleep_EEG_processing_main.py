@@ -22,7 +22,7 @@ import json
 os.chdir('C:/Users/Mitarbeiter/Documents/Gamma_Sleep/Github_Repo/Gamma-Sleep/Code/Processing')
 
 # Import custom functions
-from GammaSleep_EEG_processing_functions import load_raw, import_triggers, import_triggers_DC, score_sleep, linear_interpolation, select_annotations, create_epochs, compute_PSD, compute_SSVEP
+from GammaSleep_EEG_processing_functions import load_raw, TriggerTrain, import_triggers, import_triggers_DC, score_sleep, get_analysis_windows, get_cleaned_epochs, linear_interpolation, template_subtraction, select_annotations, compute_artifact_ptp, compute_epoch_spectra, select_spectra, compute_PSD, compute_SSVEP_stages, compute_SSVEP_trajectory, compute_envelope_40Hz
 
 # Initialize dataframe containing all paths to folders and files
 all_paths = {}
@@ -39,6 +39,32 @@ datasets_to_exclude = ['03','15']
 
 # Option: apply linear interpolation procedure to all datasets or not (supplementary analyses)
 lin_int_apply = input('\nStarting EEG preprocessing pipeline for GammaSleep. \nShould linear interpolation be applied (y/n)? ')
+
+# Option: restrict linear interpolation to stimulated periods entering the analyses (W, N2, N3, REM), instead of the whole recording;
+# analysed data are the same as with full interpolation (see check_sparse_interpolation())
+lin_int_sparse = True
+
+# Option: artifact cleaning method, if applied; 'interpolation' (linear interpolation) or 'template' (artifact template subtraction)
+artifact_cleaning = 'interpolation'
+
+# Nr. of parallel workers for the SSVEP SNR permutations (threads, safe without a __main__ guard); -1 for all CPU cores. 
+# Each worker uses up to 256 MB, all workers together at most 1 GB (see compute_random_amplitudes())
+n_jobs_SNR = 4
+
+# Option: adaptive nr. of SNR permutations, in batches of 20, stopping once the relative standard error of the noise estimate is below this value (e.g. 0.01); None for fixed 100 permutations
+SNR_tolerance = None
+
+# Option: SSVEP SNR for each ROI channel, one permutation run per channel (~7x the permutation time); False for the ROI average only
+SNR_channels = False
+
+# Frequencies (Hz) at which PSD & SNR are reported in addition to the 40 Hz metrics: stimulation frequency, harmonic, subharmonic, control frequencies
+PSD_target_freqs = [40, 80, 20, 35, 45]
+
+# Option: stream PSG channels from the EDF file, decimated to 100 Hz & band-pass filtered in one pass (see validate_PSG_stream() for the tolerance); False for MNE resampling & filtering
+stream_PSG = False
+
+# Option: data type of the EEG data, kept by all processing steps; np.float32 halves memory, with metrics within ~1e-6 (relative) of float64, PSD spectra within ~1e-4 dB
+EEG_dtype = np.float64
                             
             
 
@@ -104,8 +130,21 @@ for subject_nr in subject_IDs:
             
             # Path to output EEG curves data files
             all_paths['path_out_spectra_PSD'] = str(all_paths['path_out'] + all_paths['path_substrings'][0] + subject_nr + all_paths['path_substrings'][1] + '_PSD-output-spectra.csv')
+            
+            # Output: PSD & SNR at target frequencies
+            all_paths['path_out_targets_PSD'] = str(all_paths['path_out'] + all_paths['path_substrings'][0] + subject_nr + all_paths['path_substrings'][1] + '_PSD-output-targets.csv')
             all_paths['path_out_curves_SSVEP'] = str(all_paths['path_out'] + all_paths['path_substrings'][0] + subject_nr + all_paths['path_substrings'][1] + '_SSVEP-output-curves.csv')
             
+            # Output: SSVEP metrics per ROI channel
+            all_paths['path_out_channels_SSVEP'] = str(all_paths['path_out'] + all_paths['path_substrings'][0] + subject_nr + all_paths['path_substrings'][1] + '_SSVEP-output-channels.csv')
+            
+            # Output: SSVEP trajectory per 30 s epoch, full night & session 01 (exp only)
+            all_paths['path_out_trajectory_SSVEP'] = str(all_paths['path_out'] + all_paths['path_substrings'][0] + subject_nr + all_paths['path_substrings'][1] + '_SSVEP-output-trajectory.csv')
+            all_paths['path_out_trajectory_SSVEP_s01'] = str(all_paths['path_out'] + all_paths['path_substrings'][0] + subject_nr + all_paths['path_substrings'][1] + '_session01_SSVEP-output-trajectory.csv')
+            
+            # Output: 40 Hz envelope per 30 s epoch, full night
+            all_paths['path_out_envelope'] = str(all_paths['path_out'] + all_paths['path_substrings'][0] + subject_nr + all_paths['path_substrings'][1] + '_envelope-40Hz.csv')
+            
             # Path to output sleep variables
             all_paths['path_out_sleep'] = str(all_paths['path_out'] + all_paths['path_substrings'][0] + subject_nr + all_paths['path_substrings'][1] + '_sleep-data.csv')
             
@@ -129,7 +168,7 @@ for subject_nr in subject_IDs:
                     metadata = json.load(openfile)
                 
                 # Load s02 data, get PSG and EEG raw objects for overnight data
-                raw_PSG, raw_EEG = load_raw(all_paths['path_in_ses02_EEG'], metadata['bad_channels'])
+                raw_PSG, raw_EEG = load_raw(all_paths['path_in_ses02_EEG'], metadata['bad_channels'], stream_PSG, EEG_dtype)
             
             elif condition == 'exp':
                 
@@ -139,15 +178,15 @@ for subject_nr in subject_IDs:
                 
                 # Exception for subject 02, recording for session 01 was paused. Merging into one EDF file did not work
                 if subject_nr == '02':
-                    _, raw_s01a_EEG = load_raw(str(all_paths['path_in_ses01_EEG'][0:-12]+'a_raw-EEG.edf'), metadata['bad_channels'])
-                    _, raw_s01b_EEG = load_raw(str(all_paths['path_in_ses01_EEG'][0:-12]+'b_raw-EEG.edf'), metadata['bad_channels'])
+                    _, raw_s01a_EEG = load_raw(str(all_paths['path_in_ses01_EEG'][0:-12]+'a_raw-EEG.edf'), metadata['bad_channels'], dtype=EEG_dtype, psg=False)
+                    _, raw_s01b_EEG = load_raw(str(all_paths['path_in_ses01_EEG'][0:-12]+'b_raw-EEG.edf'), metadata['bad_channels'], dtype=EEG_dtype, psg=False)
                     raw_s01_EEG = mne.concatenate_raws([raw_s01a_EEG.copy(),raw_s01b_EEG.copy()])
                 else:
-                    # Load s01 data, get raw object for EEG data (no PSG needed, since all W)
-                    _, raw_s01_EEG = load_raw(all_paths['path_in_ses01_EEG'], metadata['bad_channels'])
+                    # Load s01 data, get raw object for EEG data (no PSG needed, since all W; PSG channels skipped)
+                    _, raw_s01_EEG = load_raw(all_paths['path_in_ses01_EEG'], metadata['bad_channels'], dtype=EEG_dtype, psg=False)
                 
                 # Load s03 data, get PSG and EEG raw objects for overnight data
-                raw_PSG, raw_EEG = load_raw(all_paths['path_in_ses03_EEG'], metadata['bad_channels'])
+                raw_PSG, raw_EEG = load_raw(all_paths['path_in_ses03_EEG'], metadata['bad_channels'], stream_PSG, EEG_dtype)
             
         except:
             
@@ -166,19 +205,19 @@ for subject_nr in subject_IDs:
             
                 if condition == 'con':      
                         
-                    triggers = import_triggers_DC(all_paths['path_in_ses02_EEG'], threshold_mV)
+                    triggers = import_triggers_DC(all_paths['path_in_ses02_EEG'], threshold_mV, stream=True)
                     
                 elif condition == 'exp':
                     
                     if subject_nr == '02': # exception: 2 files, getting triggers for each
-                        triggers_s01a = import_triggers_DC(str(all_paths['path_in_ses01_EEG'][0:-12]+'a_raw-EEG.edf'), threshold_mV)
-                        triggers_s01b = import_triggers_DC(str(all_paths['path_in_ses01_EEG'][0:-12]+'b_raw-EEG.edf'), threshold_mV)
+                        triggers_s01a = import_triggers_DC(str(all_paths['path_in_ses01_EEG'][0:-12]+'a_raw-EEG.edf'), threshold_mV, stream=True)
+                        triggers_s01b = import_triggers_DC(str(all_paths['path_in_ses01_EEG'][0:-12]+'b_raw-EEG.edf'), threshold_mV, stream=True)
                         # triggers of 1st half, directly followed by triggers of 2nd half shifted by length of 1st half
-                        triggers_s01 = np.concatenate((triggers_s01a, triggers_s01b+len(raw_s01a_EEG))) 
+                        triggers_s01 = TriggerTrain.concatenate([triggers_s01a, triggers_s01b], offsets=[0, len(raw_s01a_EEG)])
                     else:
-                        triggers_s01 = import_triggers_DC(all_paths['path_in_ses01_EEG'], threshold_mV)
+                        triggers_s01 = import_triggers_DC(all_paths['path_in_ses01_EEG'], threshold_mV, stream=True)
                         
-                    triggers = import_triggers_DC(all_paths['path_in_ses03_EEG'], threshold_mV)
+                    triggers = import_triggers_DC(all_paths['path_in_ses03_EEG'], threshold_mV, stream=True)
                     
             else: # import triggers from annotations file (default)
                 
@@ -199,20 +238,15 @@ for subject_nr in subject_IDs:
             
             if metadata['exception_trigger_exclusion'] == True:
                 
-                # Get start and end points of period to be excluded
-                exclusion_start_min = metadata['trigger_exclusion_start_min']
-                exclusion_end_min = metadata['trigger_exclusion_end_min']
+                # Get start and end points of period(s) to be excluded; 1 value or a list of values each
+                exclusion_start_min = np.atleast_1d(metadata['trigger_exclusion_start_min'])
+                exclusion_end_min = np.atleast_1d(metadata['trigger_exclusion_end_min'])
                 
                 # Transform into data points
-                exclusion_start_point = int(exclusion_start_min)*60*1000
-                exclusion_end_point = int(exclusion_end_min)*60*1000
+                exclusion_windows = [(int(start)*60*1000, int(end)*60*1000) for start, end in zip(exclusion_start_min, exclusion_end_min)]
                 
-                # Find triggers closest to indicated data points
-                exclusion_start = (abs(triggers - exclusion_start_point)).argmin()
-                exclusion_end = (abs(triggers - exclusion_end_point)).argmin()
-                
-                # Keep only intended triggers
-                triggers = np.concatenate((triggers[0:exclusion_start], triggers[exclusion_end:]))
+                # Keep only intended triggers: remove triggers between those closest to indicated data points
+                triggers = triggers.exclude_windows(exclusion_windows)
         
         except:
             
@@ -220,27 +254,6 @@ for subject_nr in subject_IDs:
             
         
         
-        # %% Apply linear interpolation (if indicated by user)
-            
-        try:
-            
-            if lin_int_apply == 'y':
-                
-                if condition == 'exp':
-                    # Run linear interpolation, S01
-                    print('Applying linear interpolation to S01...')
-                    raw_s01_EEG = linear_interpolation(raw_s01_EEG, triggers_s01)
-                
-                # Run linear interpolation, S02 or S03
-                print('Applying linear interpolation to overnight data...')
-                raw_EEG = linear_interpolation(raw_EEG, triggers)
-        
-        except:
-            
-            print('\nERROR: subject',subject_nr,', condition',condition,', section: linear interpolation\n')
-        
-        
-        
         # %% Score sleep, get epochs, store metrics
         
         try:
@@ -254,9 +267,6 @@ for subject_nr in subject_IDs:
                 # Create a 'hypnogram' containing only stage 0
                 hypno_s01 = np.zeros(int(n_wake_epochs), dtype=int) 
                 
-                # Upsample to match data (needed for SSVEP analysis)
-                hypno_up_s01 = yasa.hypno_upsample_to_data(hypno_s01, sf_hypno=1/30, data=raw_s01_EEG)
-                
                 # Turn stages into annotations, no uncertain epochs
                 raw_s01_EEG = select_annotations(raw_s01_EEG, hypno_s01, [])
             
@@ -264,7 +274,8 @@ for subject_nr in subject_IDs:
             ## Full night (session 02 or 03)
             
             # Run YASA algorithm
-            hypno, hypno_up, uncertain_epochs, sleep_stats = score_sleep(raw_PSG, raw_EEG, metadata['bad_channels'], all_paths['path_in_demographics'])
+            hypno, _, uncertain_epochs, sleep_stats, confidence = score_sleep(raw_PSG, raw_EEG, metadata['bad_channels'], all_paths['path_in_demographics'], 
+                                                                          upsample=False, return_confidence=True)
             
             # Turn stages scored with enough confidence into annotations
             raw_EEG = select_annotations(raw_EEG, hypno, uncertain_epochs)
@@ -313,6 +324,43 @@ for subject_nr in subject_IDs:
                 
 
 
+        # %% Apply linear interpolation (if indicated by user)
+        # Note: run after sleep scoring, so that interpolation can be restricted to the periods entering PSD & SSVEP analyses
+            
+        try:
+            
+            if lin_int_apply == 'y':
+                
+                # Periods to interpolate: only stages analysed, or the whole recording
+                if lin_int_sparse:
+                    # S01 contains stage 0 only; overnight stage 0 is taken from S01 in the exp condition
+                    windows_s01 = get_analysis_windows(hypno_s01, len(raw_s01_EEG), raw_s01_EEG.info['sfreq'], stages=[0]) if condition == 'exp' else None
+                    windows = get_analysis_windows(hypno, len(raw_EEG), raw_EEG.info['sfreq'], stages=[0,2,3,4] if condition == 'con' else [2,3,4])
+                else:
+                    windows_s01 = None
+                    windows = None
+                
+                # Select cleaning method
+                if artifact_cleaning == 'template':
+                    clean_artifacts = template_subtraction
+                else:
+                    clean_artifacts = linear_interpolation
+                
+                if condition == 'exp':
+                    # Run linear interpolation, S01
+                    print('Applying', artifact_cleaning, 'to S01...')
+                    raw_s01_EEG = clean_artifacts(raw_s01_EEG, triggers_s01, analysis_windows=windows_s01)
+                
+                # Run linear interpolation, S02 or S03
+                print('Applying', artifact_cleaning, 'to overnight data...')
+                raw_EEG = clean_artifacts(raw_EEG, triggers, analysis_windows=windows)
+        
+        except:
+            
+            print('\nERROR: subject',subject_nr,', condition',condition,', section: linear interpolation\n')
+        
+        
+        
         # %% Supplementary sleep parameters
         
         try:
@@ -385,6 +433,25 @@ for subject_nr in subject_IDs:
             
             
 
+        # %% Peak-to-peak amplitudes for trial rejection (PSD epochs & SSVEP segments), one pass over the data
+        
+        try:
+            
+            # Define ROI channels
+            roi_ch = ['PO3','PO4','POz','O1','O2','Oz']
+            
+            # Peak-to-peak per 30 s epoch & channel, per ROI segment
+            artifact_ptp = compute_artifact_ptp(raw_EEG, triggers, roi_ch)
+            
+            if condition == 'exp':
+                artifact_ptp_s01 = compute_artifact_ptp(raw_s01_EEG, triggers_s01, roi_ch)
+            
+        except:
+            
+            print('\nERROR: subject',subject_nr,', condition',condition,', section: artifact amplitudes\n')
+            
+            
+        
         # %% Loop over stages to compute PSD & SNR
         
         try:
@@ -395,34 +462,44 @@ for subject_nr in subject_IDs:
             # Initialize array for spectra
             PSD_spectra = []
             
+            # Initialize dict for PSD & SNR at target frequencies
+            PSD_targets = dict()
+            
+            # Compute spectra of all stimulated epochs (=30 sec trials) once, for all stages
+            epoch_spectra = compute_epoch_spectra(raw_EEG, triggers, stages=[2,3,4] if condition == 'exp' else [0,2,3,4], artifact_ptp=artifact_ptp)
+            
+            # For stage 0 exp, only data from s01 is of interest
+            if condition == 'exp':
+                epoch_spectra_s01 = compute_epoch_spectra(raw_s01_EEG, triggers_s01, stages=[0], artifact_ptp=artifact_ptp_s01)
+            
             # Loop
             for stage in [0,2,3,4]:
                 
-                # Select correct raw object and triggers
+                # Select correct spectra
                 if stage == 0 and condition == 'exp':
                     
-                    raw_loop = raw_s01_EEG # for stage 0 exp, only data from s01 is of interest
-                    triggers_loop = triggers_s01
+                    spectra_loop = epoch_spectra_s01
                     
                 else:
                     
-                    raw_loop = raw_EEG
-                    triggers_loop = triggers
-                
-                # Create and select epochs (=30 sec trials) for PSD analyses of current stage
-                epochs_stage = create_epochs(raw_loop, triggers_loop, event_id=stage)
+                    spectra_loop = epoch_spectra
                 
                 # Print nr. of epochs recorded at this stage
-                print('\nNr. of epochs recorded, stage ' + str(stage) + ': ' + str(len(epochs_stage.events)))
+                print('\nNr. of epochs recorded, stage ' + str(stage) + ': ' + str(np.count_nonzero(spectra_loop['stages'] == stage)))
+                
+                # Select spectra of good epochs for PSD analyses of current stage
+                psds_stage, freqs = select_spectra(spectra_loop, stage)
             
                 # Compute PSD and SNR spectra for current stage + metrics
-                PSD_40Hz, SNR_40Hz, PSD_spectrum, SNR_spectrum = compute_PSD(epochs_stage, stage)
+                PSD_40Hz, SNR_40Hz, PSD_spectrum, SNR_spectrum, target_metrics = compute_PSD((psds_stage, freqs), stage, target_freqs=PSD_target_freqs, return_targets=True)
+                
+                # Store PSD & SNR at target frequencies
+                stage_name = {0:'W', 2:'N2', 3:'N3', 4:'REM'}[stage]
+                PSD_targets[stage_name + '_PSD'] = [target_metrics[f][0] for f in PSD_target_freqs]
+                PSD_targets[stage_name + '_SNR'] = [target_metrics[f][1] for f in PSD_target_freqs]
                 
                 # Get nr. of trials factoring into PSD analyses for current stage
-                try:
-                    PSD_ntrials = len(epochs_stage) # only works when bad epochs have been dropped
-                except:
-                    PSD_ntrials = len(epochs_stage.events) # full list of events in case no epochs have been dropped
+                PSD_ntrials = len(psds_stage)
                     
                 # Print nr. of epochs used for analysis
                 print('Nr. of epochs used in analysis: ' + str(PSD_ntrials))   
@@ -473,6 +550,10 @@ for subject_nr in subject_IDs:
             PSD_metrics.to_csv(all_paths['path_out_metrics_PSD'], header=False)
             PSD_spectra.to_csv(all_paths['path_out_spectra_PSD'])
             
+            # PSD & SNR at target frequencies: one row per frequency
+            PSD_targets = pd.DataFrame(data=PSD_targets, index=PSD_target_freqs)
+            PSD_targets.to_csv(all_paths['path_out_targets_PSD'])
+            
         except:
             
             print('\nERROR: subject',subject_nr,', condition',condition,', section: PSD computation\n')
@@ -487,38 +568,50 @@ for subject_nr in subject_IDs:
             roi_ch = ['PO3','PO4','POz','O1','O2','Oz']
             [i for i in roi_ch if i not in metadata['bad_channels']]
             
-            # Access raw ROI data as array, convert from Volts to microVolts; get average of the ROI channels
+            # Access raw ROI data as array (channels x samples), convert from Volts to microVolts; the average of the ROI channels is derived in compute_SSVEP_stages()
             if condition == 'exp':
                 data_s01 = raw_s01_EEG.get_data(picks=roi_ch) * 1e6
-                data_s01 = np.mean(data_s01, axis=0)
             
             data = raw_EEG.get_data(picks=roi_ch) * 1e6
-            data = np.mean(data, axis=0) 
             
             # Initialize dict for output metrics
             SSVEP_metrics = dict()
             
+            # Initialize dict for output metrics per channel, ROI average as last entry
+            SSVEP_channels = dict()
+            
             # Initialize array for SSVEP curves
             SSVEP_curves = []
             
-            # Compute average SSVEP per condition
-            for stage in [0,2,3,4]:
+            # Compute average SSVEP & SNR for all stages in one pass over the data
+            if condition == 'exp':
                 
-                # Select correct raw object and triggers
-                if stage == 0 and condition == 'exp':
-                    
-                    data_loop = data_s01 # for stage 0 exp, only data from s01 is of interest
-                    triggers_loop = triggers_s01
-                    hypno_up_loop = hypno_up_s01
-                    
-                else:
-                    
-                    data_loop = data
-                    triggers_loop = triggers
-                    hypno_up_loop = hypno_up
+                # For stage 0 exp, only data from s01 is of interest
+                SSVEP_stages = compute_SSVEP_stages(data, triggers, hypno, stages=[2,3,4], computeSNR=True, n_jobs=n_jobs_SNR, SNR_tolerance=SNR_tolerance, channel_SNR=SNR_channels, 
+                                                    sfreq=raw_EEG.info['sfreq'], segment_ptp=artifact_ptp['segment_ptp'])
+                SSVEP_stages.update(compute_SSVEP_stages(data_s01, triggers_s01, hypno_s01, stages=[0], computeSNR=True, n_jobs=n_jobs_SNR, SNR_tolerance=SNR_tolerance, channel_SNR=SNR_channels, 
+                                                         sfreq=raw_s01_EEG.info['sfreq'], segment_ptp=artifact_ptp_s01['segment_ptp']))
+                
+            else:
+                
+                SSVEP_stages = compute_SSVEP_stages(data, triggers, hypno, stages=[0,2,3,4], computeSNR=True, n_jobs=n_jobs_SNR, SNR_tolerance=SNR_tolerance, channel_SNR=SNR_channels, 
+                                                    sfreq=raw_EEG.info['sfreq'], segment_ptp=artifact_ptp['segment_ptp'])
+            
+            # Collect metrics per condition
+            for stage in [0,2,3,4]:
                  
-                # Compute SSVEP and SNR for current stage + metrics
-                SSVEP_amp, SSVEP_SNR, SSVEP_ntrials, SSVEP_curve = compute_SSVEP(data_loop, triggers_loop, hypno_up_loop, stage, computeSNR=True)
+                # SSVEP and SNR for current stage + metrics, per channel
+                SSVEP_amp_ch, SSVEP_SNR_ch, SSVEP_ntrials_ch, SSVEP_curve_ch, SSVEP_SEM_ch, SSVEP_nperm_ch = SSVEP_stages[stage]
+                
+                # Store metrics per channel
+                stage_name = {0:'W', 2:'N2', 3:'N3', 4:'REM'}[stage]
+                SSVEP_channels['SSVEP_ntrials_' + stage_name] = SSVEP_ntrials_ch
+                SSVEP_channels['SSVEP_PTA_' + stage_name] = SSVEP_amp_ch
+                SSVEP_channels['SSVEP_SNR_' + stage_name] = SSVEP_SNR_ch
+                SSVEP_channels['SSVEP_npermutations_' + stage_name] = SSVEP_nperm_ch
+                
+                # ROI average (last entry)
+                SSVEP_amp, SSVEP_SNR, SSVEP_ntrials, SSVEP_curve = SSVEP_amp_ch[-1], SSVEP_SNR_ch[-1], SSVEP_ntrials_ch[-1], SSVEP_curve_ch[-1]
             
                 # Store metrics in dict
                 if stage == 0: # Wake
@@ -561,13 +654,74 @@ for subject_nr in subject_IDs:
             # Convert metrics dict into pandas as well
             SSVEP_metrics = pd.DataFrame.from_dict(SSVEP_metrics, orient='index')
             
+            # Metrics per channel: one row per ROI channel + ROI average
+            SSVEP_channels = pd.DataFrame(data=SSVEP_channels, index=roi_ch + ['ROI'])
+            
             # Save to CSV
             SSVEP_metrics.to_csv(all_paths['path_out_metrics_SSVEP'], header=False)
             SSVEP_curves.to_csv(all_paths['path_out_curves_SSVEP'])
+            SSVEP_channels.to_csv(all_paths['path_out_channels_SSVEP'])
     
         except:
             
             print('\nERROR: subject',subject_nr,', condition',condition,', section: SSVEP computation\n')
+            
+            
+        
+        # %% SSVEP trajectory across the night
+        
+        try:
+            
+            # SSVEP amplitude & nr. of trials per 30 s epoch, with stage & YASA confidence
+            SSVEP_trajectory = compute_SSVEP_trajectory(data, triggers, hypno, confidence, window_len=1, sfreq=raw_EEG.info['sfreq'])
+            
+            # Flag epochs cleaned of the LED artifact; with lin_int_sparse, epochs outside the analysed periods (e.g. N1) are not cleaned
+            if lin_int_apply == 'y':
+                SSVEP_trajectory['artifacts_cleaned'] = get_cleaned_epochs(len(hypno), len(raw_EEG), windows, raw_EEG.info['sfreq'])[SSVEP_trajectory['epoch']]
+            else:
+                SSVEP_trajectory['artifacts_cleaned'] = False
+            
+            # Save to CSV
+            SSVEP_trajectory.to_csv(all_paths['path_out_trajectory_SSVEP'], index=False)
+            
+            # Session 01 (wake, exp only); no YASA confidence
+            if condition == 'exp':
+                SSVEP_trajectory_s01 = compute_SSVEP_trajectory(data_s01, triggers_s01, hypno_s01, None, window_len=1, sfreq=raw_s01_EEG.info['sfreq'])
+                if lin_int_apply == 'y':
+                    SSVEP_trajectory_s01['artifacts_cleaned'] = get_cleaned_epochs(len(hypno_s01), len(raw_s01_EEG), windows_s01, raw_s01_EEG.info['sfreq'])[SSVEP_trajectory_s01['epoch']]
+                else:
+                    SSVEP_trajectory_s01['artifacts_cleaned'] = False
+                SSVEP_trajectory_s01.to_csv(all_paths['path_out_trajectory_SSVEP_s01'], index=False)
+            
+        except:
+            
+            print('\nERROR: subject',subject_nr,', condition',condition,', section: SSVEP trajectory\n')
+            
+            
+        
+        # %% 40 Hz envelope across the night
+        
+        try:
+            
+            # ROI channels, as for SSVEP
+            roi_ch = ['PO3','PO4','POz','O1','O2','Oz']
+            
+            # 40 Hz envelope of the ROI signal, streamed block-wise; averaged per 30 s epoch of the hypnogram
+            envelope, envelope_epochs = compute_envelope_40Hz(raw_EEG, roi_ch, hypnogram=hypno)
+            
+            # Flag epochs cleaned of the LED artifact, incl. the data points reached by the 40 Hz filter (half its default length, ~1.65 s) on each side
+            if lin_int_apply == 'y':
+                filter_margin = int(np.ceil(3.3 * raw_EEG.info['sfreq'] / 2))
+                envelope_epochs['artifacts_cleaned'] = get_cleaned_epochs(len(hypno), len(raw_EEG), windows, raw_EEG.info['sfreq'], before=filter_margin, after=filter_margin)
+            else:
+                envelope_epochs['artifacts_cleaned'] = False
+            
+            # Save to CSV
+            envelope_epochs.to_csv(all_paths['path_out_envelope'], index=False)
+            
+        except:
+            
+            print('\nERROR: subject',subject_nr,', condition',condition,', section: 40 Hz envelope\n')
 
 
 